@@ -1,9 +1,11 @@
 import os
 import re
 import json
+import queue
 import logging
 import sqlite3
 import requests
+from contextlib import contextmanager
 from typing import Optional, List, Dict, Any
 from flask import Flask, request, jsonify, make_response
 from flask_cors import CORS
@@ -24,6 +26,12 @@ MCP_API = os.getenv("MCP_API", "http://127.0.0.1:8001")
 BACKEND_PORT = int(os.getenv("BACKEND_PORT", "8000"))
 
 DEFAULT_TIMEOUT = float(os.getenv("REQUEST_TIMEOUT", "30"))
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+
+# One keep-alive session for all calls to the LLM and MCP services: requests reuse
+# pooled connections instead of opening and tearing down a socket each time.
+_HTTP = requests.Session()
+_HTTP.mount("http://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=32))
 
 # -------------------- Utilities --------------------
 def filter_resp_headers(headers: dict) -> dict:
@@ -34,15 +42,37 @@ def filter_resp_headers(headers: dict) -> dict:
     return {k: v for k, v in headers.items() if k.lower() not in hop_by_hop}
 
 # ----------------------- DB Helpers -----------------------
-def get_db_connection():
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+# Idle connections, most recently used first. Connections are autocommit and in WAL
+# mode so concurrent readers don't block the single writer.
+_DB_POOL: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+
+def _open_db_connection() -> sqlite3.Connection:
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
     conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL;")
+    conn.execute("PRAGMA synchronous=NORMAL;")
     return conn
 
-def get_db_schema() -> Dict[str, List[str]]:
-    conn = get_db_connection()
-    cur = conn.cursor()
+@contextmanager
+def get_conn():
+    """Borrow a pooled DB connection; it goes back to the pool (or is closed if the pool is full) on exit."""
+    try:
+        conn = _DB_POOL.get_nowait()
+    except queue.Empty:
+        conn = _open_db_connection()
     try:
+        yield conn
+    finally:
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            _DB_POOL.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+def get_db_schema() -> Dict[str, List[str]]:
+    with get_conn() as conn:
+        cur = conn.cursor()
         cur.execute("SELECT name FROM sqlite_master WHERE type='table';")
         tables = cur.fetchall()
         schema = {}
@@ -54,15 +84,12 @@ def get_db_schema() -> Dict[str, List[str]]:
             cols = cur.fetchall()
             schema[table] = [col[1] for col in cols]
         return schema
-    finally:
-        conn.close()
 
 def schema_as_text(schema: dict) -> str:
     return "\n".join([f"- {table}({', '.join(cols)})" for table, cols in schema.items()])
 
 def run_sql_select(sql: str, params: Optional[tuple] = None) -> List[Dict[str, Any]]:
-    conn = get_db_connection()
-    try:
+    with get_conn() as conn:
         cur = conn.cursor()
         if params:
             cur.execute(sql, params)
@@ -71,21 +98,15 @@ def run_sql_select(sql: str, params: Optional[tuple] = None) -> List[Dict[str, A
         rows = cur.fetchall()
         cols = [c[0] for c in cur.description] if cur.description else []
         return [dict(zip(cols, row)) for row in rows]
-    finally:
-        conn.close()
 
 def run_sql_modify(sql: str, params: Optional[tuple] = None) -> int:
-    conn = get_db_connection()
-    try:
+    with get_conn() as conn:
         cur = conn.cursor()
         if params:
             cur.execute(sql, params)
         else:
             cur.execute(sql)
-        conn.commit()
         return cur.rowcount
-    finally:
-        conn.close()
 
 # -------------------- Request logging --------------------
 @app.before_request
@@ -109,9 +130,8 @@ def root():
 @app.route("/health", methods=["GET"])
 def health():
     try:
-        conn = get_db_connection()
-        conn.execute("SELECT 1;")
-        conn.close()
+        with get_conn() as conn:
+            conn.execute("SELECT 1;")
         db_ok = True
     except Exception:
         logger.exception("DB health check failed")
@@ -136,29 +156,23 @@ def signup():
     if not all(k in data and str(data[k]).strip() for k in required):
         return jsonify({"error": "Missing required fields"}), 400
 
-    conn = get_db_connection()
-    cur = conn.cursor()
-    try:
-        cur.execute(
-            "INSERT INTO users (username, email, password, phone_number, role) VALUES (?,?,?,?,?)",
-            (data["username"], data["email"], data["password"], data["phone"], "user"),
-        )
-        conn.commit()
-    except sqlite3.IntegrityError as e:
-        conn.close()
-        return jsonify({"error": f"Integrity error: {e}"}), 400
-    except sqlite3.OperationalError:
+    with get_conn() as conn:
+        cur = conn.cursor()
         try:
             cur.execute(
-                "INSERT INTO users (username, email, password, phone_number) VALUES (?,?,?,?)",
-                (data["username"], data["email"], data["password"], data["phone"]),
+                "INSERT INTO users (username, email, password, phone_number, role) VALUES (?,?,?,?,?)",
+                (data["username"], data["email"], data["password"], data["phone"], "user"),
             )
-            conn.commit()
-        except Exception as e2:
-            conn.close()
-            return jsonify({"error": f"DB error: {e2}"}), 500
-    finally:
-        conn.close()
+        except sqlite3.IntegrityError as e:
+            return jsonify({"error": f"Integrity error: {e}"}), 400
+        except sqlite3.OperationalError:
+            try:
+                cur.execute(
+                    "INSERT INTO users (username, email, password, phone_number) VALUES (?,?,?,?)",
+                    (data["username"], data["email"], data["password"], data["phone"]),
+                )
+            except Exception as e2:
+                return jsonify({"error": f"DB error: {e2}"}), 500
 
     logger.info("New user created: %s", data.get("email"))
     return jsonify({"message": "User Created"}), 201
@@ -172,11 +186,10 @@ def login():
     if not email or not password:
         return jsonify({"error": "Email and password required"}), 400
 
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM users WHERE email=? AND password=?", (email, password))
-    user = cur.fetchone()
-    conn.close()
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT * FROM users WHERE email=? AND password=?", (email, password))
+        user = cur.fetchone()
 
     if user:
         role = user["role"] if "role" in user.keys() else "user"
@@ -295,7 +308,7 @@ def detect_intent(query: str) -> dict:
 # ----------------------- LLM Helpers -----------------------
 def llm_text(prompt: str) -> str:
     try:
-        r = requests.post(LLM_API, json={"prompt": prompt, "mode": "text"}, timeout=DEFAULT_TIMEOUT)
+        r = _HTTP.post(LLM_API, json={"prompt": prompt, "mode": "text"}, timeout=DEFAULT_TIMEOUT)
         r.raise_for_status()
         return (r.json().get("text") or "").strip()
     except Exception:
@@ -304,7 +317,7 @@ def llm_text(prompt: str) -> str:
 
 def llm_sql(prompt: str) -> str:
     try:
-        r = requests.post(LLM_API, json={"prompt": prompt, "mode": "sql"}, timeout=DEFAULT_TIMEOUT)
+        r = _HTTP.post(LLM_API, json={"prompt": prompt, "mode": "sql"}, timeout=DEFAULT_TIMEOUT)
         r.raise_for_status()
         return (r.json().get("sql") or "").strip()
     except Exception:
@@ -385,7 +398,7 @@ def search():
     if intent == "list_all_books":
         # Get all books from MCP registry
         try:
-            mcp_resp = requests.get(f"{MCP_API}/mcp/list_books", timeout=10)
+            mcp_resp = _HTTP.get(f"{MCP_API}/mcp/list_books", timeout=10)
             if mcp_resp.ok:
                 books = mcp_resp.json().get("books", [])
                 
@@ -477,7 +490,7 @@ def search():
         # Try to delete from MCP first (vector database)
         try:
             # Get list of books from MCP
-            mcp_resp = requests.get(f"{MCP_API}/mcp/list_books", timeout=10)
+            mcp_resp = _HTTP.get(f"{MCP_API}/mcp/list_books", timeout=10)
             if mcp_resp.ok:
                 books = mcp_resp.json().get("books", [])
                 
@@ -494,7 +507,7 @@ def search():
                 if matched_book:
                     # Delete from MCP
                     book_id = matched_book.get("book_id")
-                    del_resp = requests.post(f"{MCP_API}/mcp/delete_book", json={"book_id": book_id}, timeout=30)
+                    del_resp = _HTTP.post(f"{MCP_API}/mcp/delete_book", json={"book_id": book_id}, timeout=30)
                     
                     if del_resp.ok:
                         return jsonify({
@@ -569,7 +582,7 @@ def search():
     if intent == "book_query":
         # Try MCP RAG search first
         try:
-            rag_resp = requests.post(f"{MCP_API}/mcp/search", json={
+            rag_resp = _HTTP.post(f"{MCP_API}/mcp/search", json={
                 "query": query,
                 "user_id": user_id
             }, timeout=20)
@@ -645,14 +658,12 @@ def admin_add_book():
         return jsonify({"error": "title & author required"}), 400
 
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute(
-            "INSERT INTO books (title, author, genre) VALUES (?,?,?)",
-            (title, author, genre)
-        )
-        conn.commit()
-        conn.close()
+        with get_conn() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                "INSERT INTO books (title, author, genre) VALUES (?,?,?)",
+                (title, author, genre)
+            )
         logger.info("Added book: %s by %s", title, author)
         return jsonify({"message": "Book added"}), 201
     except Exception as e:
@@ -672,12 +683,10 @@ def admin_edit_book(book_id):
         return jsonify({"error": "No fields to update"}), 400
     vals.append(book_id)
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute(f"UPDATE books SET {', '.join(fields)} WHERE id = ?", vals)
-        conn.commit()
-        affected = cur.rowcount
-        conn.close()
+        with get_conn() as conn:
+            cur = conn.cursor()
+            cur.execute(f"UPDATE books SET {', '.join(fields)} WHERE id = ?", vals)
+            affected = cur.rowcount
         logger.info("Edited book id=%s affected=%s", book_id, affected)
         return jsonify({"message": "Book updated", "affected": affected})
     except Exception as e:
@@ -687,12 +696,10 @@ def admin_edit_book(book_id):
 @app.route("/admin/delete_book/<int:book_id>", methods=["DELETE"])
 def admin_delete_book(book_id):
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("DELETE FROM books WHERE id = ?", (book_id,))
-        conn.commit()
-        affected = cur.rowcount
-        conn.close()
+        with get_conn() as conn:
+            cur = conn.cursor()
+            cur.execute("DELETE FROM books WHERE id = ?", (book_id,))
+            affected = cur.rowcount
         logger.info("Deleted book id=%s affected=%s", book_id, affected)
         return jsonify({"message": "Book deleted", "affected": affected})
     except Exception as e:
@@ -721,14 +728,12 @@ def admin_add_user():
         return jsonify({"error": "username, email and password are required"}), 400
 
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute(
-            "INSERT INTO users (username, email, password, phone_number, role) VALUES (?,?,?,?,?)",
-            (username, email, password, phone, role)
-        )
-        conn.commit()
-        conn.close()
+        with get_conn() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                "INSERT INTO users (username, email, password, phone_number, role) VALUES (?,?,?,?,?)",
+                (username, email, password, phone, role)
+            )
         logger.info("Added user: %s (role=%s)", username, role)
         return jsonify({"message": "User added"}), 201
     except sqlite3.IntegrityError as e:
@@ -758,12 +763,10 @@ def admin_edit_user(user_id):
         return jsonify({"error": "No fields to update"}), 400
     vals.append(user_id)
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute(f"UPDATE users SET {', '.join(fields)} WHERE id = ?", vals)
-        conn.commit()
-        affected = cur.rowcount
-        conn.close()
+        with get_conn() as conn:
+            cur = conn.cursor()
+            cur.execute(f"UPDATE users SET {', '.join(fields)} WHERE id = ?", vals)
+            affected = cur.rowcount
         logger.info("Edited user id=%s affected=%s", user_id, affected)
         return jsonify({"message": "User updated", "affected": affected})
     except Exception as e:
@@ -773,12 +776,10 @@ def admin_edit_user(user_id):
 @app.route("/admin/delete_user/<int:user_id>", methods=["DELETE"])
 def admin_delete_user(user_id):
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("DELETE FROM users WHERE id = ?", (user_id,))
-        conn.commit()
-        affected = cur.rowcount
-        conn.close()
+        with get_conn() as conn:
+            cur = conn.cursor()
+            cur.execute("DELETE FROM users WHERE id = ?", (user_id,))
+            affected = cur.rowcount
         logger.info("Deleted user id=%s affected=%s", user_id, affected)
         return jsonify({"message": "User deleted", "affected": affected})
     except Exception as e:
@@ -808,7 +809,7 @@ def ingest():
         if book_id:
             data["book_id"] = book_id
 
-        resp = requests.post(f"{MCP_API}/mcp/upload", files=files, data=data, timeout=300)
+        resp = _HTTP.post(f"{MCP_API}/mcp/upload", files=files, data=data, timeout=300)
         headers = filter_resp_headers(resp.headers)
         logger.info("Forwarded ingest upload for user_id=%s title=%s (status=%s)", user_id, title, resp.status_code)
         return (resp.content, resp.status_code, headers)
@@ -819,7 +820,7 @@ def ingest():
 @app.route("/ingest/status/<upload_id>", methods=["GET"])
 def ingest_status(upload_id):
     try:
-        resp = requests.get(f"{MCP_API}/mcp/status/{upload_id}", timeout=DEFAULT_TIMEOUT)
+        resp = _HTTP.get(f"{MCP_API}/mcp/status/{upload_id}", timeout=DEFAULT_TIMEOUT)
         headers = filter_resp_headers(resp.headers)
         return (resp.content, resp.status_code, headers)
     except Exception:
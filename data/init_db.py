@@ -54,16 +54,24 @@ def seed_admin(conn: sqlite3.Connection):
         INSERT INTO users (username, email, password, phone_number, role)
         VALUES (?, ?, ?, ?, ?)
     """, ("admin", "admin@example.com", "admin123", "0000000000", "admin"))
-    conn.commit()
     print("Seeded admin user: admin@example.com / admin123 (plaintext)")
 
 
 def main():
     print("Initializing database at:", DB_FILE)
     conn = connect()
+    # autocommit mode: the module would not open a transaction for the CREATE TABLE,
+    # so BEGIN/COMMIT are issued explicitly to cover schema and seed together
+    conn.isolation_level = None
     try:
-        create_tables(conn)
-        seed_admin(conn)
+        conn.execute("BEGIN")
+        try:
+            create_tables(conn)
+            seed_admin(conn)
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
         print("Initialization complete.")
     finally:
         conn.close()
@@ -1,11 +1,14 @@
 # llm/app.py
 """
-LLM microservice for text generation and embeddings using Google Generative AI SDK.
+LLM microservice for text generation (Google Generative AI SDK) and embeddings
+(Gemini REST API over a pooled HTTP/2 client).
 
 Endpoints:
   - GET  /            -> health check
   - POST /query       -> { "prompt": "...", "mode": "sql"|"text" } -> {"text": "..."} or {"sql": "..."}
   - POST /embed       -> { "text": "single" } or { "texts": ["one","two"] } -> {"embeddings": [[...], [...]]}
+                         (JSON lines {"i": n, "v": [...]} with "Accept: application/x-ndjson";
+                          raw float32 with "Accept: application/octet-stream", see embed())
 
 Notes:
   - Configure GEMINI_API_KEY in environment (required)
@@ -13,12 +16,17 @@ Notes:
       GEMINI_TEXT_MODEL (default: "gemini-2.5-flash")
       GEMINI_EMBED_MODEL (default: "gemini-embedding-001")
       EMBED_BATCH_SIZE (default: 64)
+      GEMINI_API_BASE (default: "https://generativelanguage.googleapis.com/v1beta")
 """
 import os
+import struct
 import logging
 from typing import List
+import httpx
+import numpy as np
+import orjson
 from dotenv import load_dotenv
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_cors import CORS
 
 # third-party Google Generative AI SDK
@@ -46,6 +54,20 @@ genai.configure(api_key=GEMINI_API_KEY)
 TEXT_MODEL = os.getenv("GEMINI_TEXT_MODEL", "gemini-2.5-flash")
 EMBEDDING_MODEL = os.getenv("GEMINI_EMBED_MODEL", "gemini-embedding-001")
 BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "64"))
+GEMINI_API_BASE = os.getenv("GEMINI_API_BASE", "https://generativelanguage.googleapis.com/v1beta")
+
+# REST resource name for the embedding model ("models/<name>")
+EMBED_MODEL_PATH = EMBEDDING_MODEL if EMBEDDING_MODEL.startswith("models/") else f"models/{EMBEDDING_MODEL}"
+EMBED_URL = f"{GEMINI_API_BASE}/{EMBED_MODEL_PATH}:batchEmbedContents"
+
+# Shared HTTP/2 client for embeddings: keeps TLS sessions alive and multiplexes
+# concurrent batches instead of going through the SDK's per-call transport.
+_CLIENT = httpx.Client(
+    http2=True,
+    headers={"x-goog-api-key": GEMINI_API_KEY},
+    limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+    timeout=30.0,
+)
 
 
 def _normalize_text_response(resp) -> str:
@@ -144,56 +166,58 @@ def query():
         return jsonify({"error": "LLM query failed", "detail": str(e)}), 500
 
 
-def _extract_embeddings(raw) -> List[List[float]]:
+def _embed_batch(batch: List[str]) -> np.ndarray:
     """
-    Attempt to parse various embedding response shapes into List[List[float]].
-    Handles:
-      - dict with 'data' -> list of items containing 'embedding' / 'embeddings' / 'vector' / 'values'
-      - top-level 'embeddings' or 'embedding'
-      - a raw list-of-lists
+    Embed one batch of texts via the REST batchEmbedContents endpoint.
+    The response shape is fixed ({"embeddings": [{"values": [...]}, ...]}), so it is
+    indexed directly into a (n, dim) float32 array. Raises on HTTP or shape errors.
     """
-    embeddings = []
+    payload = {
+        "requests": [
+            {
+                "model": EMBED_MODEL_PATH,
+                "content": {"parts": [{"text": t}]},
+                "taskType": "RETRIEVAL_DOCUMENT",
+            }
+            for t in batch
+        ]
+    }
+    resp = _CLIENT.post(EMBED_URL, json=payload)
+    if resp.status_code != 200:
+        raise RuntimeError(f"batchEmbedContents returned {resp.status_code}: {resp.text[:400]}")
+    return np.asarray([e["values"] for e in resp.json()["embeddings"]], dtype=np.float32)
+
+
+def _embed_batch_with_retry(batch: List[str]) -> np.ndarray:
     try:
-        if isinstance(raw, dict) and "data" in raw and isinstance(raw["data"], list):
-            for item in raw["data"]:
-                if isinstance(item, dict):
-                    for key in ("embedding", "embeddings", "vector", "values"):
-                        if key in item and isinstance(item[key], list):
-                            # if nested list-of-lists, flatten appropriately
-                            candidate = item[key]
-                            if candidate and isinstance(candidate[0], (list, tuple)):
-                                embeddings.extend([list(c) for c in candidate])
-                            else:
-                                embeddings.append(list(candidate))
-                            break
-                    else:
-                        # try to find a numeric-list value
-                        for v in item.values():
-                            if isinstance(v, list) and v and all(isinstance(x, (int, float)) for x in v):
-                                embeddings.append(list(v))
-                                break
-                else:
-                    # item might itself be a list of numbers
-                    if isinstance(item, (list, tuple)) and item and all(isinstance(x, (int, float)) for x in item):
-                        embeddings.append(list(item))
-        elif isinstance(raw, dict):
-            for key in ("embeddings", "embedding", "vector", "values"):
-                if key in raw and isinstance(raw[key], list):
-                    candidate = raw[key]
-                    if candidate and isinstance(candidate[0], (list, tuple)):
-                        embeddings.extend([list(c) for c in candidate])
-                    else:
-                        embeddings.append(list(candidate))
-                    break
-        elif isinstance(raw, list):
-            if raw and isinstance(raw[0], (list, tuple)):
-                embeddings = [list(r) for r in raw]
-            elif raw and all(isinstance(x, (int, float)) for x in raw):
-                embeddings = [list(raw)]
-    except Exception:
-        logger.exception("Error while extracting embeddings")
+        return _embed_batch(batch)
+    except httpx.TransportError as e_embed:
+        # connection dropped/reset: retry once on a fresh pooled connection
+        logger.debug("embed request failed, retrying: %s", e_embed)
+        return _embed_batch(batch)
+
 
-    return embeddings
+def _stream_embeddings(texts: List[str]):
+    """
+    Yield one JSON line {"i": index, "v": [...]} per input text, batch by batch.
+    Only one batch of vectors is alive at a time; on failure a final
+    {"error": ...} line is emitted and the stream ends.
+    """
+    for i in range(0, len(texts), BATCH_SIZE):
+        batch = texts[i : i + BATCH_SIZE]
+        try:
+            batch_embeddings = _embed_batch_with_retry(batch)
+        except Exception as e:
+            logger.exception("Embedding call failed for batch")
+            yield orjson.dumps({"error": "Embedding call failed for batch", "detail": str(e)}) + b"\n"
+            return
+        if batch_embeddings.shape[0] != len(batch):
+            logger.warning("Embedding count mismatch: inputs=%d embeddings=%d", len(batch), batch_embeddings.shape[0])
+            yield orjson.dumps({"error": "Embedding count mismatch (inputs vs parsed embeddings)"}) + b"\n"
+            return
+        for j, vec in enumerate(batch_embeddings):
+            yield orjson.dumps({"i": i + j, "v": vec}, option=orjson.OPT_SERIALIZE_NUMPY) + b"\n"
+        del batch_embeddings
 
 
 @app.route("/embed", methods=["POST"])
@@ -206,6 +230,11 @@ def embed():
 
     Returns:
       { "embeddings": [[...], [...], ...] }
+    or, when the request has "Accept: application/x-ndjson", one line per text:
+      {"i": 0, "v": [...]}\n{"i": 1, "v": [...]}\n...
+    or, when the request prefers "application/octet-stream", raw little-endian bytes:
+      n (uint32) | dim (uint32) | n*dim float32 values, row-major
+    Errors are always JSON.
     """
     data = request.get_json(force=True, silent=True) or {}
 
@@ -216,58 +245,47 @@ def embed():
     else:
         return jsonify({"error": "Provide 'text' (string) or 'texts' (list of strings) in the JSON body"}), 400
 
-    if not all(isinstance(t, str) for t in texts):
-        return jsonify({"error": "'texts' must be a list of strings"}), 400
-
     if len(texts) == 0:
         return jsonify({"error": "'texts' must contain at least one string"}), 400
 
+    # exact type check skips the MRO walk of isinstance and stops at the first bad item
+    if not all(type(t) is str for t in texts):
+        return jsonify({"error": "'texts' must be a list of strings"}), 400
+
+    if request.accept_mimetypes.best == "application/x-ndjson":
+        return Response(stream_with_context(_stream_embeddings(texts)), mimetype="application/x-ndjson")
+
     try:
-        all_embeddings: List[List[float]] = []
+        all_embeddings: List[np.ndarray] = []
         for i in range(0, len(texts), BATCH_SIZE):
             batch = texts[i : i + BATCH_SIZE]
-            # Primary call
             try:
-                raw_result = genai.embed_content(
-                    model=EMBEDDING_MODEL,
-                    content=batch,
-                    task_type="retrieval_document"
-                )
+                batch_embeddings = _embed_batch_with_retry(batch)
             except Exception as e_embed:
-                logger.debug("genai.embed_content failed: %s", e_embed)
-                # fallback attempt
-                try:
-                    # raw_result = genai.embeddings.create(model=EMBEDDING_MODEL, input=batch)
-                    raw_result = genai.embed_content(
-                        model=EMBEDDING_MODEL,
-                        content=batch,
-                        task_type="retrieval_document"  # or "retrieval_query" depending on use case
-                        )
-                    
-                except Exception as e_fb2:
-                    logger.exception("Embedding calls failed for batch")
-                    return jsonify({"error": "Embedding call failed for batch", "detail": str(e_fb2)}), 500
-
-            batch_embeddings = _extract_embeddings(raw_result)
-            if not batch_embeddings:
-                logger.error("Could not parse embeddings for batch; raw preview: %s", str(raw_result)[:400])
-                return jsonify({
-                    "error": "Could not parse embeddings from model response",
-                    "raw_preview": str(raw_result)[:400]
-                }), 500
-
-            all_embeddings.extend(batch_embeddings)
+                logger.exception("Embedding call failed for batch")
+                return jsonify({"error": "Embedding call failed for batch", "detail": str(e_embed)}), 500
+
+            all_embeddings.append(batch_embeddings)
 
         # validate count
-        if len(all_embeddings) != len(texts):
-            logger.warning("Embedding count mismatch: inputs=%d embeddings=%d", len(texts), len(all_embeddings))
+        parsed = sum(e.shape[0] for e in all_embeddings)
+        if parsed != len(texts):
+            logger.warning("Embedding count mismatch: inputs=%d embeddings=%d", len(texts), parsed)
             return jsonify({
                 "error": "Embedding count mismatch (inputs vs parsed embeddings)",
                 "inputs": len(texts),
-                "embeddings_parsed": len(all_embeddings)
+                "embeddings_parsed": parsed
             }), 500
 
-        return jsonify({"embeddings": all_embeddings})
+        embeddings = np.vstack(all_embeddings)
+        if request.accept_mimetypes.best == "application/octet-stream":
+            # no text encoding at all: the client maps the bytes straight back into an array
+            out = np.ascontiguousarray(embeddings, dtype="<f4")
+            return Response(struct.pack("<II", *out.shape) + out.tobytes(), mimetype="application/octet-stream")
+
+        # orjson serializes the float32 buffer directly (no per-float Python repr)
+        body = orjson.dumps({"embeddings": embeddings}, option=orjson.OPT_SERIALIZE_NUMPY)
+        return Response(body, mimetype="application/json")
     except Exception as e:
         logger.exception("Embedding endpoint failed")
         return jsonify({"error": "Embedding Model Error", "detail": str(e)}), 500
@@ -1,20 +1,37 @@
 import os
 import time
+import atexit
+import hashlib
 import uuid
 import json
 import threading
 import sqlite3
 import traceback
+import queue
+import struct
+import multiprocessing
+from contextlib import contextmanager
+from itertools import repeat
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 from typing import List, Optional
 from flask import Flask, request, jsonify, send_file
 from flask_cors import CORS
 from dotenv import load_dotenv
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import faiss
 import numpy as np
+from cachetools import LRUCache
+
+try:
+    from numba import njit, prange
+except ImportError:  # numba is optional; only used when faiss lacks normalize_L2
+    njit = None
 
 # local utils expected in same package
-from utils import ensure_dir, extract_text_from_pdf, chunk_text, safe_write_json, safe_read_json
+from utils import ensure_dir, extract_and_chunk, safe_write_json, safe_read_json, json_loads
 
 load_dotenv()
 
@@ -26,22 +43,114 @@ DATA_DIR = os.getenv("MCP_DATA_DIR", "../data/mcp")
 UPLOADS_DIR = os.path.join(DATA_DIR, "uploads")
 INDEX_DIR = os.path.join(DATA_DIR, "faiss")
 META_PATH = os.path.join(DATA_DIR, "metadata.json")
+# journal written by older versions; migrated into the chunks table on startup
+META_JOURNAL_PATH = os.path.join(DATA_DIR, "metadata.jsonl")
 STATUS_DB = os.path.join(DATA_DIR, "status.sqlite")
 LLM_EMBED_ENDPOINT = os.getenv("LLM_EMBED_ENDPOINT", "http://127.0.0.1:5000/embed")
 LLM_TEXT_ENDPOINT = os.getenv("LLM_TEXT_ENDPOINT", "http://127.0.0.1:5000/query")
 EMBED_BATCH = int(os.getenv("EMBED_BATCH", "64"))
+# Number of embed requests kept in flight against LLM_EMBED_ENDPOINT (across all uploads)
+EMBED_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", "4"))
+# How long (ms) the embed batcher waits for other uploads' batches to merge into one request
+EMBED_COALESCE_MS = float(os.getenv("EMBED_COALESCE_MS", "20"))
+# Worker processes for PDF text extraction + chunking (CPU-bound, so threads would share the GIL)
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", str(os.cpu_count() or 4)))
 # If EMBED_DIM env is provided it will set a suggested default. Real dim validated on first embed.
 EMBED_DIM = int(os.getenv("EMBED_DIM", "0"))
+# Set EMBED_NORMALIZED=1 when the embed endpoint already returns unit-length vectors to skip normalization
+EMBED_NORMALIZED = os.getenv("EMBED_NORMALIZED", "0").lower() in ("1", "true", "yes")
+# Index type for newly built indexes:
+#   "hnsw"  - graph index, sub-linear search, ~1.5x the RAM of raw vectors (default)
+#   "flat"  - exact brute-force inner product
+#   "sq_fp16" - exact scan over vectors stored as float16; half the RAM/disk of "flat",
+#             recall is practically unchanged for normalized embeddings
+#   "sq8"   - scan over vectors quantized to int8 per dimension; a quarter of the RAM and
+#             scan bandwidth of "flat". The per-dimension ranges are trained, so vectors are
+#             buffered (and searched exactly) until SQ_TRAIN_MIN arrive.
+#   "ivfpq" - IVF + product quantization; ~16 bytes/vector instead of 4*dim, lower recall.
+#             Needs training, so vectors are buffered (and searched exactly) until enough arrive.
+#   "auto"  - "flat" while the library is small, switching to IVF-Flat with nlist = 4*sqrt(n)
+#             (capped at n/10 so it trains right away on the stored embeddings) once it
+#             reaches AUTO_IVF_MIN vectors
+INDEX_TYPE = os.getenv("INDEX_TYPE", "hnsw").lower()
+AUTO_IVF_MIN = int(os.getenv("AUTO_IVF_MIN", "5000"))
+# HNSW graph parameters: M neighbours per node, build/search beam widths (higher = better recall, slower)
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 200
+EMBED_EF_SEARCH = int(os.getenv("EMBED_EF_SEARCH", "64"))
+# IVFPQ parameters: coarse cells, PQ sub-quantizers (must divide dim), cells probed per query
+IVF_NLIST = int(os.getenv("IVF_NLIST", "4096"))
+PQ_M = int(os.getenv("PQ_M", "16"))
+PQ_NBITS = 8
+NPROBE = int(os.getenv("NPROBE", "16"))
+# sq8 trains once this many vectors are available; training uses at most TRAIN_SAMPLE_MAX rows
+SQ_TRAIN_MIN = int(os.getenv("SQ_TRAIN_MIN", "5000"))
+TRAIN_SAMPLE_MAX = 100_000
+# GPU search (faiss-gpu builds only) is opt-in. The index moves to GPU 0 once it holds
+# GPU_MIN_VECTORS vectors and fits in GPU_MEM_LIMIT_MB; below that, and for unbatched
+# single queries, the CPU is faster. GPU_FLOAT16 stores the GPU copy as float16.
+USE_GPU = os.getenv("USE_GPU", "0").lower() in ("1", "true", "yes")
+GPU_MIN_VECTORS = int(os.getenv("GPU_MIN_VECTORS", "100000"))
+GPU_MEM_LIMIT_MB = int(os.getenv("GPU_MEM_LIMIT_MB", "4096"))
+GPU_FLOAT16 = os.getenv("GPU_FLOAT16", "1").lower() in ("1", "true", "yes")
+# Single /mcp/search queries arriving within SEARCH_BATCH_MS of each other are searched
+# together as one (B, d) matrix, at most SEARCH_BATCH_MAX per FAISS call
+SEARCH_BATCH_MS = float(os.getenv("SEARCH_BATCH_MS", "5"))
+SEARCH_BATCH_MAX = int(os.getenv("SEARCH_BATCH_MAX", "64"))
+# Entries kept in each of the query-embedding and search-result LRU caches
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "10000"))
+# OpenMP threads FAISS uses for batched searches
+FAISS_THREADS = int(os.getenv("FAISS_THREADS", str(os.cpu_count() or 4)))
 
 ensure_dir(DATA_DIR)
 ensure_dir(UPLOADS_DIR)
 ensure_dir(INDEX_DIR)
 
-# metadata.json keeps a mapping of vector-id -> metadata
+# ----------------- Vector normalization -----------------
+if njit is not None:
+    # separate 1D/2D kernels: numba compiles one signature per ndim
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _nb_normalize_rows(x):
+        n, d = x.shape
+        for i in prange(n):
+            s = 0.0
+            for j in range(d):
+                s += x[i, j] * x[i, j]
+            if s > 0.0:
+                inv = 1.0 / np.sqrt(s)
+                for j in range(d):
+                    x[i, j] *= inv
+
+    @njit(fastmath=True, cache=True)
+    def _nb_normalize_vec(x):
+        s = 0.0
+        for j in range(x.shape[0]):
+            s += x[j] * x[j]
+        if s > 0.0:
+            inv = 1.0 / np.sqrt(s)
+            for j in range(x.shape[0]):
+                x[j] *= inv
+
+def normalize_L2(x: np.ndarray):
+    """
+    L2-normalize a C-contiguous float32 array in place (rows for 2D input).
+    Zero vectors are left untouched. Uses faiss.normalize_L2 when the build
+    provides it, else a numba kernel, else plain numpy.
+    """
+    if hasattr(faiss, "normalize_L2"):
+        faiss.normalize_L2(x.reshape(1, -1) if x.ndim == 1 else x)
+    elif njit is not None:
+        (_nb_normalize_vec if x.ndim == 1 else _nb_normalize_rows)(x)
+    else:
+        # einsum sums squares without the (n, d) temporary np.linalg.norm builds
+        rows = x.reshape(-1, x.shape[-1])
+        sq = np.einsum("ij,ij->i", rows, rows)
+        sq[sq == 0] = 1.0
+        rows *= (1.0 / np.sqrt(sq))[:, None]
+
+# metadata.json keeps embed_dim; books and per-vector metadata live in the books and
+# chunks tables of status.sqlite (see below)
 metadata = safe_read_json(META_PATH, default={})
-metadata.setdefault("vectors", {})
-metadata.setdefault("index_id_list", [])
-metadata.setdefault("books", {})
 # store embed_dim in metadata if present
 if "embed_dim" not in metadata:
     if EMBED_DIM and EMBED_DIM > 0:
@@ -53,36 +162,249 @@ else:
         EMBED_DIM = int(metadata.get("embed_dim", EMBED_DIM))
     except Exception:
         pass
-metadata.setdefault("next_int_id", 1)
+
+def save_metadata():
+    safe_write_json(META_PATH, metadata)
 
 # FAISS index object and index path
 index_path = os.path.join(INDEX_DIR, "faiss.index")
+# normalized vectors waiting for an untrained (IVF) index to collect enough training data
+pending_path = os.path.join(INDEX_DIR, "pending.npy")
+# normalized float32 embeddings, row i = FAISS row i (chunks.row_id); used to rebuild the index
+vectors_path = os.path.join(INDEX_DIR, "vectors.f32")
+# vectors.f32 compacted by a book delete, renamed over it once the delete has committed
+compact_vectors_path = vectors_path + ".compact"
+_vectors_mm: Optional[np.memmap] = None
 _index: Optional[faiss.Index] = None
+# Serializes index mutation (add, rebuild, re-init) and searches across request threads;
+# FAISS adds aren't safe to run alongside other operations on the same index.
+_index_lock = threading.RLock()
+# Index writes happen on a background thread: _index_version counts changes,
+# _written_version is the last one on disk, _index_dirty wakes the writer.
+_write_lock = threading.Lock()
+_index_dirty = threading.Event()
+_index_version = 0
+_written_version = 0
+_pending_vecs: Optional[np.ndarray] = None
+# GPU resources are created once and shared; _index_on_gpu tells the writer to copy back to CPU
+_gpu_res = None
+_index_on_gpu = False
+# set when cloning to GPU failed (index type without a GPU implementation); not retried
+_gpu_failed = False
+
+def _place_index(index):
+    """
+    Move a CPU index onto GPU 0 (same search/add interface) when USE_GPU is set, a CUDA
+    device is available and the trained index is within the GPU_MIN_VECTORS /
+    GPU_MEM_LIMIT_MB bounds; otherwise, or if the index type has no GPU implementation,
+    keep it on CPU.
+    """
+    global _gpu_res, _index_on_gpu, _gpu_failed
+    _index_on_gpu = False
+    if not USE_GPU or _gpu_failed or not hasattr(faiss, "StandardGpuResources") or faiss.get_num_gpus() == 0:
+        return index
+    if not index.is_trained or index.ntotal < GPU_MIN_VECTORS:
+        return index
+    if index.ntotal * index.d * (2 if GPU_FLOAT16 else 4) > GPU_MEM_LIMIT_MB << 20:
+        return index
+    try:
+        if _gpu_res is None:
+            _gpu_res = faiss.StandardGpuResources()
+        co = faiss.GpuClonerOptions()
+        co.useFloat16 = GPU_FLOAT16
+        gpu_index = faiss.index_cpu_to_gpu(_gpu_res, 0, index, co)
+        _index_on_gpu = True
+        print(f"[mcp] FAISS index ({index.ntotal} vectors) moved to GPU 0.")
+        return gpu_index
+    except Exception as e:
+        _gpu_failed = True
+        print("[mcp] Could not move FAISS index to GPU, staying on CPU:", e)
+        return index
+
+def _replace_file(path: str, write):
+    """Write via write(fileobj) to path.tmp, then atomically rename it over path."""
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        write(f)
+    os.replace(tmp, path)
+
+def write_faiss_index():
+    """
+    Write the current index (and any pending untrained vectors) to disk.
+    The index is serialized to memory under the index lock (copied back to CPU first if
+    it lives on GPU); the file write itself happens outside the lock via temp file + rename.
+    """
+    global _written_version
+    with _write_lock:
+        with _index_lock:
+            if _index is None:
+                return
+            version = _index_version
+            cpu_index = faiss.index_gpu_to_cpu(_index) if _index_on_gpu else _index
+            data = faiss.serialize_index(cpu_index)
+            pending = _pending_vecs
+        _replace_file(index_path, data.tofile)
+        if pending is not None:
+            _replace_file(pending_path, lambda f: np.save(f, pending))
+        elif os.path.exists(pending_path):
+            os.remove(pending_path)
+        _written_version = version
+
+def _mark_index_dirty():
+    """Schedule a background write of the index."""
+    global _index_version
+    _index_version += 1
+    _index_dirty.set()
+
+def _index_writer():
+    while True:
+        _index_dirty.wait()
+        _index_dirty.clear()
+        try:
+            write_faiss_index()
+        except Exception as e:
+            print("[mcp] Warning: failed to write FAISS index to disk:", e)
+
+def _write_index_at_exit():
+    if _written_version != _index_version:
+        write_faiss_index()
 
-def init_faiss(dim: int):
+def _new_index(dim: int, ntotal: int = 0):
+    """
+    Build an empty index of the configured INDEX_TYPE (inner product on normalized vectors == cosine).
+    ntotal is the number of vectors about to be added; "auto" uses it to pick flat vs IVF.
+    """
+    if INDEX_TYPE == "auto":
+        if ntotal < AUTO_IVF_MIN:
+            return faiss.IndexFlatIP(dim)
+        # 4*sqrt(n) cells, but never more than _min_train_size() lets the n stored vectors train
+        nlist = max(1, min(int(4 * np.sqrt(ntotal)), ntotal // 10))
+        quantizer = faiss.IndexFlatIP(dim)
+        return faiss.IndexIVFFlat(quantizer, dim, nlist, faiss.METRIC_INNER_PRODUCT)
+    if INDEX_TYPE == "flat":
+        return faiss.IndexFlatIP(dim)
+    if INDEX_TYPE == "sq_fp16":
+        # fp16 needs no training data, so the index is usable (is_trained) immediately
+        return faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_fp16, faiss.METRIC_INNER_PRODUCT)
+    if INDEX_TYPE == "sq8":
+        return faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+    if INDEX_TYPE == "ivfpq":
+        quantizer = faiss.IndexFlatIP(dim)
+        return faiss.IndexIVFPQ(quantizer, dim, IVF_NLIST, PQ_M, PQ_NBITS, faiss.METRIC_INNER_PRODUCT)
+    # HNSW needs no training and supports incremental add; search is sub-linear in ntotal.
+    index = faiss.IndexHNSWFlat(dim, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+    index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+    return index
+
+def _configure_search(index):
+    """Apply query-time knobs (HNSW efSearch, IVF nprobe) to a freshly created/loaded index."""
+    if hasattr(index, "hnsw"):
+        index.hnsw.efSearch = EMBED_EF_SEARCH
+    if hasattr(index, "nprobe"):
+        index.nprobe = NPROBE
+    return index
+
+def _min_train_size(index) -> int:
+    if not hasattr(index, "nlist"):
+        # scalar quantizer: only per-dimension value ranges are learned
+        return SQ_TRAIN_MIN
+    # ~10 points per IVF cell, and at least one per PQ centroid
+    if hasattr(index, "pq"):
+        return max(10 * index.nlist, 1 << PQ_NBITS)
+    return 10 * index.nlist
+
+def _needs_ivf_upgrade() -> bool:
+    """True when INDEX_TYPE=auto and a flat index has grown past AUTO_IVF_MIN."""
+    return INDEX_TYPE == "auto" and _index is not None and not hasattr(_index, "nlist") and _row_count >= AUTO_IVF_MIN
+
+def _index_add(vecs_np: np.ndarray):
+    """
+    Add normalized vectors to _index. An untrained index buffers them until there is
+    enough training data, then trains once and adds the whole buffer in order.
     """
-    Initialize the global FAISS index object. If an index file exists try to load it
-    (and validate dim), otherwise create a new IndexFlatIP with given dim.
+    global _pending_vecs
+    if _index.is_trained:
+        _index.add(vecs_np)
+        return
+    if _pending_vecs is None:
+        _pending_vecs = vecs_np.copy()
+    else:
+        _pending_vecs = np.concatenate([_pending_vecs, vecs_np])
+    if _pending_vecs.shape[0] >= _min_train_size(_index):
+        sample = _pending_vecs
+        if sample.shape[0] > TRAIN_SAMPLE_MAX:
+            rows = np.random.default_rng(0).choice(sample.shape[0], TRAIN_SAMPLE_MAX, replace=False)
+            sample = sample[np.sort(rows)]
+        print(f"[mcp] Training FAISS index on {sample.shape[0]} vectors.")
+        _index.train(sample)
+        _index.add(_pending_vecs)
+        _pending_vecs = None
+
+def _indexed_count() -> int:
+    """Number of searchable vectors, including any buffered for training."""
+    n = _index.ntotal if _index is not None else 0
+    return n + (_pending_vecs.shape[0] if _pending_vecs is not None else 0)
+
+def _search_index(q_vec: np.ndarray, k: int):
+    """Search _index; while an IVF index is still untrained, search the buffered vectors exactly."""
+    if _pending_vecs is not None and _index.ntotal == 0:
+        return faiss.knn(q_vec, _pending_vecs, k, metric=faiss.METRIC_INNER_PRODUCT)
+    return _index.search(q_vec, k)
+
+def init_faiss(dim: int, fresh: bool = False, ntotal: int = 0):
     """
-    global _index, EMBED_DIM
+    Initialize the global FAISS index object. Unless `fresh` is set, try to load an
+    existing index file (and validate dim), otherwise create a new index of INDEX_TYPE
+    sized for `ntotal` vectors.
+    """
+    global _index, EMBED_DIM, _pending_vecs
     EMBED_DIM = int(dim)
+    _pending_vecs = None
     # try load existing index if present
-    if os.path.exists(index_path):
+    if not fresh and os.path.exists(index_path):
         try:
-            _index = faiss.read_index(index_path)
-            print(f"[mcp] Loaded existing FAISS index from {index_path} (dim {EMBED_DIM}).")
-            return
+            loaded = faiss.read_index(index_path)
+            if loaded.d == EMBED_DIM:
+                if not loaded.is_trained and os.path.exists(pending_path):
+                    _pending_vecs = np.load(pending_path)
+                _index = _place_index(_configure_search(loaded))
+                print(f"[mcp] Loaded existing FAISS index from {index_path} (dim {EMBED_DIM}).")
+                return
+            print(f"[mcp] Existing FAISS index has dim {loaded.d}, expected {EMBED_DIM}; recreating.")
         except Exception as e:
             print("[mcp] Failed to load existing FAISS index, will recreate. Error:", e)
 
-    # create new index (IndexFlatIP expects normalized vectors for cosine-like search)
-    _index = faiss.IndexFlatIP(EMBED_DIM)
-    print(f"[mcp] Created new FAISS IndexFlatIP with dim={EMBED_DIM}.")
+    _index = _place_index(_configure_search(_new_index(EMBED_DIM, ntotal)))
+    print(f"[mcp] Created new FAISS {INDEX_TYPE} index ({type(_index).__name__}) with dim={EMBED_DIM}.")
+
+# Each thread keeps its own status DB connection (opened once, never closed). In WAL mode
+# readers on one connection don't block the writer on another, and commits append to the
+# WAL instead of fsyncing the main file. The schema is created by init_status_db() at startup.
+_db_local = threading.local()
+
+def _get_conn() -> sqlite3.Connection:
+    conn = getattr(_db_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(STATUS_DB, check_same_thread=False, isolation_level=None, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL;")
+        conn.execute("PRAGMA synchronous=NORMAL;")
+        conn.execute("PRAGMA wal_autocheckpoint=1000;")
+        _db_local.conn = conn
+    return conn
+
+STATUS_COLUMNS = ["upload_id","filename","title","author","user_id","status","created_at","processed_chunks","total_chunks","error"]
+
+# Per-vector metadata columns of the chunks table; row_id is the vector's FAISS row.
+CHUNK_FIELDS = ("upload_id", "book_id", "title", "author", "genre", "user_id", "text", "start", "end", "filename", "created_at")
+_CHUNK_COLS = ", ".join(f'"{f}"' for f in CHUNK_FIELDS)
+# Columns of the books table besides book_id
+BOOK_FIELDS = ("title", "author", "genre", "filename", "upload_id", "created_at")
+# stay under SQLite's bound-parameter limit in "row_id IN (...)" lookups
+_SQL_IN_MAX = 900
 
 def init_status_db():
-    conn = sqlite3.connect(STATUS_DB)
-    cur = conn.cursor()
-    cur.execute("""
+    conn = _get_conn()
+    conn.execute("""
         CREATE TABLE IF NOT EXISTS uploads (
             upload_id TEXT PRIMARY KEY,
             filename TEXT,
@@ -96,67 +418,289 @@ def init_status_db():
             error TEXT
         )
     """)
-    conn.commit()
-    conn.close()
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS chunks (
+            row_id INTEGER PRIMARY KEY,
+            vid TEXT UNIQUE,
+            upload_id TEXT,
+            book_id TEXT,
+            title TEXT,
+            author TEXT,
+            genre TEXT,
+            user_id TEXT,
+            text TEXT,
+            start INTEGER,
+            "end" INTEGER,
+            filename TEXT,
+            created_at REAL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_chunks_user ON chunks(user_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_chunks_upload ON chunks(upload_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_chunks_book ON chunks(book_id)")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS books (
+            book_id TEXT PRIMARY KEY,
+            title TEXT,
+            author TEXT,
+            genre TEXT,
+            filename TEXT,
+            upload_id TEXT,
+            created_at REAL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_books_upload ON books(upload_id)")
 
-init_status_db()
 
-# If EMBED_DIM was recorded in metadata use that; else if env provided use env; else leave 0 until first embed
-if metadata.get("embed_dim", 0):
-    EMBED_DIM = int(metadata["embed_dim"])
-if EMBED_DIM and EMBED_DIM > 0:
-    init_faiss(EMBED_DIM)
-else:
-    # create a tiny placeholder index until we know the dimension (will be reinitialized later)
-    print("[mcp] EMBED_DIM unknown at startup; FAISS will be initialized upon first embeddings.")
+@contextmanager
+def _db_txn():
+    """Run a group of statements on the status DB as one transaction."""
+    conn = _get_conn()
+    # take the write lock up front so a concurrent writer waits instead of failing the upgrade
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+def _count_chunks() -> int:
+    return _get_conn().execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+def _vectors_map(dim: int, min_rows: int = 0) -> np.memmap:
+    """Map vectors.f32 as a (capacity, dim) float32 array, doubling the file until it holds min_rows."""
+    global _vectors_mm
+    row_bytes = 4 * dim
+    cap = (os.path.getsize(vectors_path) if os.path.exists(vectors_path) else 0) // row_bytes
+    if cap < min_rows:
+        cap = max(min_rows, 2 * cap, 1024)
+        with open(vectors_path, "ab") as f:
+            f.truncate(cap * row_bytes)
+    elif _vectors_mm is not None and _vectors_mm.shape == (cap, dim):
+        return _vectors_mm
+    _vectors_mm = np.memmap(vectors_path, dtype=np.float32, mode="r+", shape=(cap, dim))
+    return _vectors_mm
+
+def _write_vectors(start_row: int, vecs_np: np.ndarray):
+    global _vectors_mm
+    if start_row == 0 and os.path.exists(vectors_path):
+        # no rows yet: whatever is in the file (possibly another dim) is stale
+        _vectors_mm = None
+        os.remove(vectors_path)
+    mm = _vectors_map(vecs_np.shape[1], start_row + vecs_np.shape[0])
+    mm[start_row:start_row + vecs_np.shape[0]] = vecs_np
+    mm.flush()
+
+def _insert_chunks(start_row: int, vec_ids: List[str], vecs_np: np.ndarray, columns: dict):
+    """
+    Store vectors at rows start_row, start_row+1, ... of vectors.f32 and insert their
+    metadata rows in a single transaction. The sidecar is written first, so rows past the
+    committed count are at worst unused space.
+    columns maps CHUNK_FIELDS names to a list (one value per vector) or to a single value
+    shared by every vector; missing fields are NULL.
+    """
+    _write_vectors(start_row, vecs_np)
+    n = len(vec_ids)
+    cols = [v if isinstance(v, (list, tuple)) else repeat(v, n) for v in (columns.get(f) for f in CHUNK_FIELDS)]
+    rows = zip(range(start_row, start_row + n), vec_ids, *cols)
+    with _db_txn() as conn:
+        conn.executemany(
+            f"INSERT INTO chunks (row_id, vid, {_CHUNK_COLS}) VALUES ({','.join('?' * (len(CHUNK_FIELDS) + 2))})",
+            rows,
+        )
+
+def _insert_book(book_id: str, **fields):
+    """Register a book; the first upload for a book_id wins (later ones leave the row as is)."""
+    _get_conn().execute(
+        f"INSERT OR IGNORE INTO books (book_id, {', '.join(BOOK_FIELDS)}) VALUES ({','.join('?' * (len(BOOK_FIELDS) + 1))})",
+        [book_id] + [fields.get(f) for f in BOOK_FIELDS],
+    )
+
+def _get_book(book_id: str) -> Optional[dict]:
+    row = _get_conn().execute(f"SELECT {', '.join(BOOK_FIELDS)} FROM books WHERE book_id = ?", (book_id,)).fetchone()
+    return dict(zip(BOOK_FIELDS, row)) if row else None
+
+def _delete_chunks_for_book(book_id: str) -> np.ndarray:
+    """
+    Delete a book and its chunks and renumber the rest to 0..n-1, keeping their order (= new
+    FAISS rows), and compact vectors.f32 to match. Returns the remaining (n, dim) embeddings.
+    The compacted file is written before the renumbering commits and renamed over vectors.f32
+    right after; _recover_compacted_vectors() finishes (or drops) it after a crash in between.
+    """
+    global _vectors_mm
+    dim = int(metadata.get("embed_dim") or 0)
+    compact = bool(dim) and os.path.exists(vectors_path)
+    emb = np.empty((0, dim), dtype=np.float32)
+    try:
+        with _db_txn() as conn:
+            conn.execute("DELETE FROM books WHERE book_id = ?", (book_id,))
+            conn.execute("DELETE FROM chunks WHERE book_id = ?", (book_id,))
+            kept = [r[0] for r in conn.execute("SELECT row_id FROM chunks ORDER BY row_id")]
+            conn.execute("CREATE TEMP TABLE renum (old INTEGER PRIMARY KEY, new INTEGER)")
+            conn.execute("INSERT INTO renum SELECT row_id, ROW_NUMBER() OVER (ORDER BY row_id) - 1 FROM chunks")
+            # go through negative ids so no intermediate state collides on the primary key
+            conn.execute("UPDATE chunks SET row_id = -1 - (SELECT new FROM renum WHERE old = chunks.row_id)")
+            conn.execute("UPDATE chunks SET row_id = -1 - row_id")
+            conn.execute("DROP TABLE renum")
+            if compact:
+                # one fancy-indexed copy of the kept rows, in the new row order
+                emb = np.array(_vectors_map(dim)[kept])
+                emb.tofile(compact_vectors_path)
+    except BaseException:
+        if os.path.exists(compact_vectors_path):
+            os.remove(compact_vectors_path)
+        raise
+    if compact:
+        _vectors_mm = None
+        os.replace(compact_vectors_path, vectors_path)
+    return emb
+
+def _recover_compacted_vectors():
+    """
+    A compacted vectors.f32 left behind by a delete that crashed between COMMIT and rename
+    matches the chunks table exactly when the delete committed; otherwise it is stale.
+    """
+    if not os.path.exists(compact_vectors_path):
+        return
+    dim = int(metadata.get("embed_dim") or 0)
+    if dim and os.path.getsize(compact_vectors_path) == _count_chunks() * 4 * dim:
+        os.replace(compact_vectors_path, vectors_path)
+        print(f"[mcp] Finished compacting {vectors_path} after an interrupted delete.")
+    else:
+        os.remove(compact_vectors_path)
+
+def _load_embeddings(dim: int) -> np.ndarray:
+    """All stored (normalized) embeddings as an (n, dim) float32 array in row order."""
+    mm = _vectors_map(dim)
+    if mm.shape[0] < _row_count:
+        raise RuntimeError(f"{vectors_path} holds {mm.shape[0]} vectors, chunks table has {_row_count}")
+    return np.array(mm[:_row_count])
+
+def _migrate_chunk_blobs():
+    """Chunk tables from before vectors.f32 kept each embedding in a BLOB column; move them out."""
+    conn = _get_conn()
+    if "embedding" not in [r[1] for r in conn.execute("PRAGMA table_info(chunks)")]:
+        return
+    dim = int(metadata.get("embed_dim") or 0)
+    if dim and not os.path.exists(vectors_path):
+        blobs = [r[0] for r in conn.execute("SELECT embedding FROM chunks ORDER BY row_id")]
+        emb = np.frombuffer(b"".join(blobs), dtype=np.float32).reshape(-1, dim).copy()
+        # rows migrated from metadata.json went in raw; normalizing is a no-op for the rest
+        if not EMBED_NORMALIZED:
+            normalize_L2(emb)
+        _replace_file(vectors_path, emb.tofile)
+        print(f"[mcp] Moved {emb.shape[0]} embeddings from {STATUS_DB} to {vectors_path}.")
+    conn.execute("ALTER TABLE chunks DROP COLUMN embedding")
+
+def _migrate_legacy_metadata():
+    """
+    Older versions kept every vector's metadata (and embedding) in metadata.json plus the
+    metadata.jsonl journal. Move those into the chunks table and shrink metadata.json.
+    """
+    metadata.setdefault("books", {})
+    vectors = metadata.pop("vectors", None) or {}
+    order = list(metadata.pop("index_id_list", None) or [])
+    metadata.pop("next_int_id", None)
+    if os.path.exists(META_JOURNAL_PATH):
+        with open(META_JOURNAL_PATH, "rb") as f:
+            for line in f:
+                try:
+                    rec = json_loads(line)
+                except ValueError:
+                    continue
+                if rec.get("op") == "vec":
+                    if rec["vid"] not in vectors:
+                        order.append(rec["vid"])
+                    vectors[rec["vid"]] = rec["meta"]
+                elif rec.get("op") == "book":
+                    metadata["books"].setdefault(rec["book_id"], rec["book"])
+    for b in metadata["books"].values():
+        b.pop("vector_ids", None)
+    order = [vid for vid in order if vectors.get(vid, {}).get("embedding")]
+    if order and _count_chunks() == 0:
+        metas = [vectors[vid] for vid in order]
+        vecs = np.asarray([m["embedding"] for m in metas], dtype=np.float32)
+        # metadata.json kept the raw embeddings (only the old delete rebuild normalized them);
+        # vectors.f32 holds normalized rows, so normalize once here
+        if not EMBED_NORMALIZED:
+            normalize_L2(vecs)
+        if not metadata.get("embed_dim"):
+            metadata["embed_dim"] = vecs.shape[1]
+        _insert_chunks(0, order, vecs, {f: [m.get(f) for m in metas] for f in CHUNK_FIELDS})
+        print(f"[mcp] Migrated {len(order)} vectors from metadata.json into {STATUS_DB}.")
+    save_metadata()
+    if os.path.exists(META_JOURNAL_PATH):
+        os.remove(META_JOURNAL_PATH)
+
+def _migrate_books_from_metadata():
+    """The book registry used to be metadata.json's "books" map; move it into the books table."""
+    books = metadata.pop("books")
+    for bid, b in books.items():
+        _insert_book(bid, **b)
+    save_metadata()
+    if books:
+        print(f"[mcp] Migrated {len(books)} books from metadata.json into {STATUS_DB}.")
+
+# number of chunk rows == number of vectors the index should hold (changed under _index_lock;
+# counted by init_service())
+_row_count = 0
 
 # ----------------- Status helpers -----------------
 def set_status_row(upload_id, **kwargs):
-    conn = sqlite3.connect(STATUS_DB)
-    cur = conn.cursor()
-    cur.execute("SELECT upload_id FROM uploads WHERE upload_id = ?", (upload_id,))
-    exists = cur.fetchone() is not None
-    if exists:
-        sets = ", ".join([f"{k}=?" for k in kwargs.keys()])
-        vals = list(kwargs.values())
-        vals.append(upload_id)
-        cur.execute(f"UPDATE uploads SET {sets} WHERE upload_id = ?", vals)
-    else:
-        now = time.time()
-        cur.execute("""
-            INSERT INTO uploads (upload_id, filename, title, author, user_id, status, created_at, processed_chunks, total_chunks, error)
-            VALUES (?,?,?,?,?,?,?,?,?,?)
-        """, (
-            upload_id,
-            kwargs.get("filename"),
-            kwargs.get("title"),
-            kwargs.get("author"),
-            kwargs.get("user_id"),
-            kwargs.get("status", "created"),
-            now,
-            kwargs.get("processed_chunks", 0),
-            kwargs.get("total_chunks", 0),
-            kwargs.get("error")
-        ))
-    conn.commit()
-    conn.close()
+    """
+    Insert or update the status row for upload_id in a single UPSERT statement.
+    New rows get defaults for missing columns; existing rows only change the given columns.
+    """
+    row = {"status": "created", "processed_chunks": 0, "total_chunks": 0, **kwargs}
+    row["upload_id"] = upload_id
+    row["created_at"] = time.time()
+    cols = [c for c in STATUS_COLUMNS if c in row]
+    updates = ", ".join(f"{k}=excluded.{k}" for k in kwargs) or "upload_id=upload_id"
+    sql = (
+        f"INSERT INTO uploads ({', '.join(cols)}) VALUES ({','.join('?' * len(cols))}) "
+        f"ON CONFLICT(upload_id) DO UPDATE SET {updates}"
+    )
+    _get_conn().execute(sql, [row[c] for c in cols])
 
 def get_status_row(upload_id):
-    conn = sqlite3.connect(STATUS_DB)
-    cur = conn.cursor()
-    cur.execute("SELECT upload_id, filename, title, author, user_id, status, created_at, processed_chunks, total_chunks, error FROM uploads WHERE upload_id = ?", (upload_id,))
+    cur = _get_conn().execute(f"SELECT {', '.join(STATUS_COLUMNS)} FROM uploads WHERE upload_id = ?", (upload_id,))
     row = cur.fetchone()
-    conn.close()
     if not row:
         return None
-    keys = ["upload_id","filename","title","author","user_id","status","created_at","processed_chunks","total_chunks","error"]
-    return dict(zip(keys,row))
+    return dict(zip(STATUS_COLUMNS, row))
 
 # ----------------- Embedding helpers -----------------
-def _extract_embeddings_from_llm_response(resp_json):
+# Shared keep-alive session for the embed/text endpoints. The pool must hold at least
+# EMBED_CONCURRENCY connections; connect failures and transient 429/5xx replies are retried
+# per request with jittered exponential backoff, honouring Retry-After (both endpoints are
+# safe to repeat, so POST is retried too). Jitter keeps concurrent batches from retrying in
+# lockstep. Read timeouts are not retried: the request may still be running upstream, and
+# repeating a slow generation would outlast the caller's own timeout several times over.
+_http = requests.Session()
+_http.mount("http://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=max(32, EMBED_CONCURRENCY * 2),
+    max_retries=Retry(
+        total=3,
+        read=0,
+        backoff_factor=0.2,
+        backoff_jitter=0.2,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=frozenset(["POST"]),
+        raise_on_status=False,
+    ),
+))
+
+# Extractor compiled from the last embed-response shape seen (see _embed_path_for); later
+# responses of the same shape are indexed directly instead of being searched again.
+_embed_extractor = None
+
+def _embed_path_for(resp_json) -> tuple:
     """
-    Extract embeddings from various JSON shapes returned by LLM embed endpoints.
-    Returns list-of-lists (embeddings).
+    Work out where the embeddings sit in an LLM embed response (various JSON shapes) and
+    return that location as a path of steps: a dict key / list index, ("*", keys) to take
+    the first present key of every dict item of a list, or "wrap" for a single embedding.
     """
     if not isinstance(resp_json, dict):
         raise ValueError("LLM embed response is not a JSON object")
@@ -165,249 +709,469 @@ def _extract_embeddings_from_llm_response(resp_json):
     if "embeddings" in resp_json:
         val = resp_json["embeddings"]
         if isinstance(val, list):
-            return val
+            return ("embeddings",)
         if isinstance(val, dict):
             # nested shapes
             if "embedding" in val and isinstance(val["embedding"], list):
-                return val["embedding"]
+                return ("embeddings", "embedding")
             if "data" in val and isinstance(val["data"], list):
-                out = []
-                for item in val["data"]:
-                    if isinstance(item, dict) and "embedding" in item:
-                        out.append(item["embedding"])
-                    elif isinstance(item, dict) and "vector" in item:
-                        out.append(item["vector"])
-                if out:
-                    return out
+                if any(isinstance(item, dict) and ("embedding" in item or "vector" in item) for item in val["data"]):
+                    return ("embeddings", "data", ("*", ("embedding", "vector")))
 
     # single "embedding"
     if "embedding" in resp_json and isinstance(resp_json["embedding"], list):
-        return [resp_json["embedding"]]
+        return ("embedding", "wrap")
 
     # openai-like "data": [{embedding: [...]}, ...]
     if "data" in resp_json and isinstance(resp_json["data"], list):
-        out = []
-        for item in resp_json["data"]:
-            if isinstance(item, dict):
-                if "embedding" in item and isinstance(item["embedding"], list):
-                    out.append(item["embedding"])
-                elif "vector" in item and isinstance(item["vector"], list):
-                    out.append(item["vector"])
-        if out:
-            return out
+        if any(isinstance(item, dict) and (isinstance(item.get("embedding"), list) or isinstance(item.get("vector"), list))
+               for item in resp_json["data"]):
+            return ("data", ("*", ("embedding", "vector")))
 
     # nested "result" or other wrappers
     if "result" in resp_json and isinstance(resp_json["result"], dict):
-        return _extract_embeddings_from_llm_response(resp_json["result"])
+        return ("result",) + _embed_path_for(resp_json["result"])
 
     # recursive search fallback
-    def find_list_of_number_lists(obj):
+    def find_list_of_number_lists(obj, path):
         if isinstance(obj, list):
             if all(isinstance(el, (list, tuple)) for el in obj) and len(obj) > 0 and all(all(isinstance(x, (int, float)) for x in el) for el in obj):
-                return obj
-            for el in obj:
-                f = find_list_of_number_lists(el)
-                if f:
+                return path
+            for i, el in enumerate(obj):
+                f = find_list_of_number_lists(el, path + (i,))
+                if f is not None:
                     return f
         elif isinstance(obj, dict):
-            for v in obj.values():
-                f = find_list_of_number_lists(v)
-                if f:
+            for k, v in obj.items():
+                f = find_list_of_number_lists(v, path + (k,))
+                if f is not None:
                     return f
         return None
 
-    found = find_list_of_number_lists(resp_json)
-    if found:
+    found = find_list_of_number_lists(resp_json, ())
+    if found is not None:
         return found
 
     raise ValueError("Couldn't find embeddings in LLM response (unexpected JSON shape)")
 
-def call_llm_embed(texts: List[str]) -> List[List[float]]:
+def _compile_embed_path(path: tuple):
+    """Turn a path from _embed_path_for into a function that indexes straight to the embeddings."""
+    def step_fn(step):
+        if step == "wrap":
+            return lambda obj: [obj]
+        if isinstance(step, tuple):
+            keys = step[1]
+            return lambda obj: [
+                next(item[k] for k in keys if k in item)
+                for item in obj if isinstance(item, dict) and any(k in item for k in keys)
+            ]
+        return lambda obj: obj[step]
+
+    steps = [step_fn(step) for step in path]
+
+    def extract(resp_json):
+        obj = resp_json
+        for fn in steps:
+            obj = fn(obj)
+        return obj
+    return extract
+
+def _extract_embeddings_from_llm_response(resp_json):
+    """
+    Extract embeddings from various JSON shapes returned by LLM embed endpoints.
+    Returns list-of-lists (embeddings). Uses the extractor for the last shape seen when it
+    fits, otherwise finds the shape again and caches a new extractor.
+    """
+    global _embed_extractor
+    if _embed_extractor is not None:
+        try:
+            embs = _embed_extractor(resp_json)
+            if isinstance(embs, list) and embs:
+                return embs
+        except (KeyError, IndexError, TypeError, StopIteration):
+            pass
+    extractor = _compile_embed_path(_embed_path_for(resp_json))
+    embs = extractor(resp_json)
+    _embed_extractor = extractor
+    return embs
+
+def _embeddings_fast_path(data) -> Optional[np.ndarray]:
+    """
+    Our own embed endpoint answers {"embeddings": [[...], ...]}; convert that shape straight
+    to a float32 array. Returns None for any other shape so the generic walker can run.
+    """
+    val = data.get("embeddings") if isinstance(data, dict) else None
+    if not isinstance(val, list) or not val or not isinstance(val[0], list) or not val[0]:
+        return None
+    if type(val[0][0]) not in (float, int):
+        return None
+    try:
+        arr = np.asarray(val, dtype=np.float32)
+    except (ValueError, TypeError):
+        return None
+    return arr if arr.ndim == 2 else None
+
+def _embeddings_from_binary(content: bytes) -> np.ndarray:
+    """Decode the embed endpoint's binary reply: n (uint32) | dim (uint32) | n*dim float32 (little-endian)."""
+    if len(content) < 8:
+        raise RuntimeError("Binary embed response is truncated")
+    n, dim = struct.unpack_from("<II", content)
+    if n == 0 or dim == 0 or len(content) != 8 + 4 * n * dim:
+        raise RuntimeError(f"Binary embed response has bad shape/length ({n}x{dim}, {len(content)} bytes)")
+    return np.frombuffer(content, dtype="<f4", offset=8).reshape(n, dim)
+
+def call_llm_embed(texts: List[str]) -> np.ndarray:
     """
     Call the configured LLM embedding endpoint with JSON {"texts": [...]}
-    and return list-of-list embeddings. Raises on failure.
+    and return the embeddings as an (n, dim) float32 array. Raises on failure.
+    Raw float32 bytes are requested; endpoints that only speak JSON still work.
     """
     payload = {"texts": texts}
     try:
-        resp = requests.post(LLM_EMBED_ENDPOINT, json=payload, timeout=60)
+        resp = _http.post(
+            LLM_EMBED_ENDPOINT,
+            json=payload,
+            headers={"Accept": "application/octet-stream, application/json;q=0.9"},
+            timeout=60,
+        )
     except Exception as e:
         raise RuntimeError(f"HTTP call to embed endpoint failed: {e}")
 
+    if resp.ok and resp.headers.get("Content-Type", "").startswith("application/octet-stream"):
+        arr = _embeddings_from_binary(resp.content)
+        if not np.isfinite(arr).all():
+            raise RuntimeError("Embeddings contain non-finite values")
+        return arr
+
     try:
-        data = resp.json()
+        data = json_loads(resp.content)
     except Exception:
         raise RuntimeError(f"Embed endpoint returned non-JSON: {resp.text[:1000]} (status {resp.status_code})")
 
+    arr = _embeddings_fast_path(data)
+    if arr is not None:
+        if not np.isfinite(arr).all():
+            raise RuntimeError("Embeddings contain non-finite values")
+        return arr
+
     # extract embeddings
     embs = _extract_embeddings_from_llm_response(data)
     if not isinstance(embs, list) or len(embs) == 0:
         raise RuntimeError("No embeddings parsed from LLM response")
 
-    # validate numeric and consistent dims
-    first_len = None
-    for i, e in enumerate(embs):
-        if not isinstance(e, (list, tuple)):
-            raise RuntimeError(f"Embedding {i} is not a list")
-        if len(e) == 0:
-            raise RuntimeError(f"Embedding {i} is empty")
-        if not all(isinstance(x, (int, float)) for x in e):
-            raise RuntimeError(f"Embedding {i} contains non-numeric values")
-        if first_len is None:
-            first_len = len(e)
-        elif len(e) != first_len:
-            raise RuntimeError("Inconsistent embedding lengths in LLM response")
-    return embs
+    # validate numeric and consistent dims (numpy infers the dtype/shape in C; strings,
+    # None or nested junk give a non-numeric dtype, ragged rows a ValueError or ndim != 2)
+    try:
+        arr = np.array(embs)
+    except ValueError:
+        raise RuntimeError("Inconsistent embedding lengths in LLM response")
+    if arr.ndim != 2 or arr.shape[1] == 0:
+        raise RuntimeError("Embeddings must be non-empty lists of equal length")
+    if arr.dtype.kind not in "iuf":
+        raise RuntimeError("Embeddings contain non-numeric values")
+    arr = arr.astype(np.float32)
+    if not np.isfinite(arr).all():
+        raise RuntimeError("Embeddings contain non-finite values")
+    return arr
+
+class EmbedBatcher:
+    """
+    Coalesces embed requests from concurrent uploads into fewer, fuller POSTs.
+    embed(texts) returns a Future for that caller's embeddings. A single consumer thread
+    merges queued requests up to max_texts (waiting at most `window` seconds for more)
+    and posts them on a pool, with at most max_inflight requests outstanding; while all
+    slots are busy new requests keep queueing, so partial batches fill up.
+    If a merged POST fails, each caller's texts are retried on their own, so one bad
+    request doesn't fail the others it was merged with.
+    """
 
-def normalize_vectors(vs: np.ndarray) -> np.ndarray:
-    norms = np.linalg.norm(vs, axis=1, keepdims=True)
-    norms[norms == 0] = 1.0
-    return vs / norms
+    def __init__(self, max_texts: int, window: float, max_inflight: int):
+        self._queue = queue.Queue()
+        self._max_texts = max_texts
+        self._window = window
+        self._slots = threading.BoundedSemaphore(max_inflight)
+        self._pool = ThreadPoolExecutor(max_workers=max_inflight, thread_name_prefix="embed")
+        threading.Thread(target=self._run, name="embed-batcher", daemon=True).start()
+
+    def embed(self, texts: List[str]) -> Future:
+        fut = Future()
+        self._queue.put((list(texts), fut))
+        return fut
+
+    def _run(self):
+        carry = None
+        while True:
+            self._slots.acquire()
+            group = [carry if carry is not None else self._queue.get()]
+            carry = None
+            n = len(group[0][0])
+            deadline = time.monotonic() + self._window
+            while n < self._max_texts:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if n + len(item[0]) > self._max_texts:
+                    carry = item
+                    break
+                group.append(item)
+                n += len(item[0])
+            # drop requests whose caller already gave up (cancelled futures)
+            group = [(texts, fut) for texts, fut in group if fut.set_running_or_notify_cancel()]
+            if group:
+                self._pool.submit(self._post, group)
+            else:
+                self._slots.release()
 
-def add_vectors_to_index(vec_ids: List[str], vectors: List[List[float]], metadatas: List[dict]):
+    def _post(self, group):
+        try:
+            try:
+                embs = self._embed_group(group)
+            except Exception:
+                if len(group) == 1:
+                    raise
+                # find out whose texts failed: the rest still get their embeddings
+                for item in group:
+                    try:
+                        item[1].set_result(self._embed_group([item])[0])
+                    except Exception as e:
+                        item[1].set_exception(e)
+                return
+            for (_, fut), emb in zip(group, embs):
+                fut.set_result(emb)
+        except Exception as e:
+            for _, fut in group:
+                if not fut.done():
+                    fut.set_exception(e)
+        finally:
+            self._slots.release()
+
+    @staticmethod
+    def _embed_group(group) -> List[np.ndarray]:
+        """One embed call for all texts in group; returns each caller's slice."""
+        embs = call_llm_embed([t for texts, _ in group for t in texts])
+        if len(embs) != sum(len(texts) for texts, _ in group):
+            raise RuntimeError("Embed endpoint returned a different number of embeddings than texts")
+        out, pos = [], 0
+        for texts, _ in group:
+            out.append(embs[pos:pos + len(texts)])
+            pos += len(texts)
+        return out
+
+# process-wide embed queue for ingestion (queries call call_llm_embed directly: no coalescing
+# delay); created by init_service()
+_embed_batcher: Optional[EmbedBatcher] = None
+
+def add_vectors_to_index_bulk(vec_ids: List[str], vecs_np: np.ndarray, columns: dict):
     """
-    Add vectors to FAISS index, update metadata, and persist index+metadata.
+    Add a pre-built (n, dim) float32 array of normalized vectors to the FAISS index and
+    insert their metadata rows into the chunks table in one transaction (the vectors
+    themselves go to vectors.f32, for rebuilds). Metadata is columnar, see _insert_chunks.
+    The index file isn't written here; call _flush_index_and_meta() after.
     This function will create/re-init the FAISS index if embed dim differs and index is empty.
+    Caller must hold _index_lock.
     """
-    global _index, EMBED_DIM, metadata  # <<< ensure we refer to module-level variables
-    if len(vectors) == 0:
+    global _index, EMBED_DIM, metadata, _row_count  # <<< ensure we refer to module-level variables
+    if vecs_np.shape[0] == 0:
         return
 
-    vecs_np = np.array(vectors, dtype=np.float32)
     vec_dim = vecs_np.shape[1]
 
     # If we didn't know EMBED_DIM yet, attempt to set it and init index
     if not EMBED_DIM or EMBED_DIM == 0:
-        init_faiss(vec_dim)
-        EMBED_DIM = vec_dim
+        init_faiss(vec_dim, fresh=True)
         metadata["embed_dim"] = EMBED_DIM
-        safe_write_json(META_PATH, metadata)
+        save_metadata()
 
     if vec_dim != EMBED_DIM:
         # if index has no vectors, we can re-init; otherwise that's an error
-        if len(metadata.get("index_id_list", [])) == 0:
-            init_faiss(vec_dim)
-            EMBED_DIM = vec_dim
+        if _row_count == 0:
+            init_faiss(vec_dim, fresh=True)
             metadata["embed_dim"] = EMBED_DIM
-            safe_write_json(META_PATH, metadata)
+            save_metadata()
         else:
             raise RuntimeError(f"Embedding dimension mismatch: index dim {EMBED_DIM} vs vec dim {vec_dim}")
 
-    # normalize, add to index
-    vecs_np = normalize_vectors(vecs_np)
     if _index is None:
         init_faiss(EMBED_DIM)
+
+    # rows first: if the FAISS add fails they are removed again, so both stay aligned
+    start_row = _row_count
+    _insert_chunks(start_row, vec_ids, vecs_np, columns)
     try:
-        _index.add(vecs_np)
+        _index_add(vecs_np)
     except Exception as e:
+        with _db_txn() as conn:
+            conn.execute("DELETE FROM chunks WHERE row_id >= ?", (start_row,))
         raise RuntimeError(f"FAISS add failed: {e}")
+    _row_count = start_row + len(vec_ids)
 
-    # persist metadata and embedding copies for rebuilds
-    for vid, meta, emb in zip(vec_ids, metadatas, vectors):
-        metadata["index_id_list"].append(vid)
-        metadata["vectors"][vid] = meta.copy()
-        # store embedding for rebuild
-        metadata["vectors"][vid]["embedding"] = [float(x) for x in emb]
-        # link to book registry
-        book_id = meta.get("book_id")
-        if book_id:
-            b = metadata.setdefault("books", {}).setdefault(book_id, {
-                "title": meta.get("title", ""),
-                "author": meta.get("author", ""),
-                "genre": "",
-                "filename": meta.get("filename", ""),
-                "upload_id": meta.get("upload_id"),
-                "vector_ids": [],
-                "created_at": time.time()
-            })
-            if vid not in b.get("vector_ids", []):
-                b.setdefault("vector_ids", []).append(vid)
+def _flush_index_and_meta():
+    """
+    Schedule a background write of the FAISS index (chunk rows are already committed).
+    With INDEX_TYPE=auto a flat index that has outgrown AUTO_IVF_MIN is rebuilt as IVF first,
+    and with USE_GPU a CPU index that is now large enough is moved to the GPU.
+    """
+    global _index
+    if _needs_ivf_upgrade():
+        print(f"[mcp] {_row_count} vectors >= AUTO_IVF_MIN={AUTO_IVF_MIN}; rebuilding as IVF index.")
+        _rebuild_index_from_db()
+    if _index is not None:
+        if USE_GPU and not _index_on_gpu:
+            # a CPU index that has grown past GPU_MIN_VECTORS moves over now
+            _index = _place_index(_index)
+        _mark_index_dirty()
+
+def _rebuild_index_from_db(emb_np: Optional[np.ndarray] = None):
+    """
+    Recreate the FAISS index from the stored embeddings (vectors.f32, in row order), or
+    from emb_np when the caller already has them in memory.
+    """
+    global _index
+    if _row_count == 0:
+        # reset empty index
+        if metadata.get("embed_dim", 0):
+            init_faiss(metadata.get("embed_dim"), fresh=True)
+        else:
+            _index = None
+        return 0
 
-    safe_write_json(META_PATH, metadata)
-    # persist FAISS
-    try:
-        faiss.write_index(_index, index_path)
-    except Exception as e:
-        print("[mcp] Warning: failed to write FAISS index to disk:", e)
+    # stored embeddings were normalized before they were added, so no second pass here
+    if emb_np is None:
+        emb_np = _load_embeddings(int(metadata["embed_dim"]))
+    init_faiss(emb_np.shape[1], fresh=True, ntotal=emb_np.shape[0])
+    _index_add(emb_np)
+    return emb_np.shape[0]
 
 # ----------------- Background processing -----------------
+_pdf_pool: Optional[ProcessPoolExecutor] = None
+_pdf_pool_lock = threading.Lock()
+
+def _get_pdf_pool() -> ProcessPoolExecutor:
+    """
+    Create the PDF worker pool on first use rather than at import (e.g. in a gunicorn master).
+    Workers come from a forkserver: forking this process directly, with its batcher/writer
+    threads and FAISS's OpenMP pool running, can copy a held lock into the child and hang it.
+    """
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is None:
+            _pdf_pool = ProcessPoolExecutor(
+                max_workers=max(1, PDF_WORKERS),
+                mp_context=multiprocessing.get_context("forkserver"),
+            )
+        return _pdf_pool
+
+def _extract_chunks(file_path: str, book_id):
+    """
+    Run extract_and_chunk on the PDF pool. A worker that dies (native crash in the PDF
+    parser, OOM kill) breaks the whole pool, so a broken pool is dropped for a fresh one
+    and the job retried once; if it breaks again only this upload fails.
+    """
+    global _pdf_pool
+    for attempt in range(2):
+        pool = _get_pdf_pool()
+        try:
+            return pool.submit(extract_and_chunk, file_path, 1200, 200, book_id).result()
+        except BrokenProcessPool:
+            with _pdf_pool_lock:
+                # another upload may have replaced it already
+                if _pdf_pool is pool:
+                    _pdf_pool = None
+                    pool.shutdown(wait=False, cancel_futures=True)
+            print(f"[mcp] PDF worker pool broke while processing {file_path}; replaced it.")
+            if attempt:
+                raise
+
 def process_upload(upload_id, file_path, title, author, user_id, book_id=None, genre=""):
     """
     Background worker:
      - extract text
      - chunk
      - embed in batches
-     - add to index + metadata
+     - add to index + metadata (once, after the last batch; nothing is persisted per batch)
     """
     try:
         set_status_row(upload_id, status="processing", filename=os.path.basename(file_path), title=title, author=author, user_id=user_id, processed_chunks=0, total_chunks=0)
-        text = extract_text_from_pdf(file_path)
-        if not text or not text.strip():
+        # extraction + chunking run in a worker process; chunk_text propagates book_id per chunk
+        chunks = _extract_chunks(file_path, book_id)
+        if chunks is None:
             set_status_row(upload_id, status="error", error="No text extracted from PDF")
             return
 
-        # chunk_text should accept book_id for per-chunk metadata propagation
-        chunks = chunk_text(text, chunk_size_chars=1200, overlap_chars=200, book_id=book_id)
         total = len(chunks)
         if total == 0:
             set_status_row(upload_id, status="error", error="No chunks produced from document")
             return
 
+        # one timestamp for the book entry and every chunk row of this upload
+        now = time.time()
+
         # prepare book registry entry WITH GENRE
         if book_id:
-            metadata.setdefault("books", {})
-            if book_id not in metadata["books"]:
-                metadata["books"][book_id] = {
-                    "title": title,
-                    "author": author,
-                    "genre": genre,  # NEW: Store genre
-                    "filename": os.path.basename(file_path),
-                    "upload_id": upload_id,
-                    "vector_ids": [],
-                    "created_at": time.time()
-                }
-                safe_write_json(META_PATH, metadata)
+            _insert_book(
+                book_id,
+                title=title,
+                author=author,
+                genre=genre,  # NEW: Store genre
+                filename=os.path.basename(file_path),
+                upload_id=upload_id,
+                created_at=now,
+            )
 
         set_status_row(upload_id, status="embedding", processed_chunks=0, total_chunks=total)
 
-        # batching
+        # batching: queue every batch on the shared embed batcher (merged with other uploads'
+        # batches, several requests in flight), then add everything to FAISS in one call
         batch_size = EMBED_BATCH if EMBED_BATCH and EMBED_BATCH > 0 else 32
-        for i in range(0, total, batch_size):
-            batch = chunks[i:i+batch_size]
-            texts = [c["text"] for c in batch]
-            try:
-                embs = call_llm_embed(texts)
-            except Exception as e:
-                set_status_row(upload_id, status="error", error=f"Embed call failed: {e}")
-                return
+        batches = [chunks[i:i+batch_size] for i in range(0, total, batch_size)]
+        vecs_buf = None  # (total, dim) float32, allocated once the first batch reveals dim
+        futures = {_embed_batcher.embed([c["text"] for c in batch]): bi for bi, batch in enumerate(batches)}
+        processed = 0
+        try:
+            for fut in as_completed(futures):
+                bi = futures[fut]
+                try:
+                    embs = fut.result()
+                except Exception as e:
+                    set_status_row(upload_id, status="error", error=f"Embed call failed: {e}")
+                    return
+                # results arrive out of order; copy each into its row slice of the buffer
+                arr = np.asarray(embs, dtype=np.float32)
+                if vecs_buf is None:
+                    vecs_buf = np.empty((total, arr.shape[1]), dtype=np.float32)
+                start = bi * batch_size
+                rows = vecs_buf[start:start + len(batches[bi])]
+                rows[:] = arr
+                if not EMBED_NORMALIZED:
+                    # normalize the rows while they are still in cache instead of another full pass later
+                    normalize_L2(rows)
+                processed += len(batches[bi])
+                set_status_row(upload_id, status="embedding", processed_chunks=processed, total_chunks=total)
+        finally:
+            for fut in futures:
+                fut.cancel()
+
+        # metadata columns in chunk order; upload-level fields are one value for all chunks
+        vec_ids = [c["id"] for c in chunks]
+        columns = {
+            "upload_id": upload_id,
+            "book_id": book_id,
+            "title": title,
+            "author": author,
+            "genre": genre,  # NEW: Include genre in vector metadata
+            "user_id": user_id,
+            "text": [c["text"] for c in chunks],
+            "start": [c.get("start") for c in chunks],
+            "end": [c.get("end") for c in chunks],
+            "filename": os.path.basename(file_path),
+            "created_at": now
+        }
 
-            # prepare metadata and ids for this batch
-            vec_ids = []
-            vecs = []
-            metas = []
-            for c, emb in zip(batch, embs):
-                vid = c["id"]
-                meta = {
-                    "upload_id": upload_id,
-                    "book_id": book_id,
-                    "title": title,
-                    "author": author,
-                    "genre": genre,  # NEW: Include genre in vector metadata
-                    "user_id": user_id,
-                    "text": c["text"],
-                    "start": c.get("start"),
-                    "end": c.get("end"),
-                    "filename": os.path.basename(file_path),
-                    "created_at": time.time()
-                }
-                vec_ids.append(vid)
-                vecs.append(emb)
-                metas.append(meta)
-
-            # add to index and persist after each batch
-            add_vectors_to_index(vec_ids, vecs, metas)
-
-            processed = min(i + batch_size, total)
-            set_status_row(upload_id, status="indexed", processed_chunks=processed, total_chunks=total)
+        # one FAISS add + one write for the whole upload
+        with _index_lock:
+            add_vectors_to_index_bulk(vec_ids, vecs_buf, columns)
+            _flush_index_and_meta()
 
         set_status_row(upload_id, status="done", processed_chunks=total, total_chunks=total)
     except Exception as e:
@@ -416,6 +1180,163 @@ def process_upload(upload_id, file_path, title, author, user_id, book_id=None, g
         print(tb)
         set_status_row(upload_id, status="error", error=str(e))
 
+# ----------------- Search helpers -----------------
+# Query embeddings are cached by query text; search results by (index version, query, top_k),
+# so any change to the index (which bumps _index_version) makes older results unreachable.
+_embed_cache = LRUCache(maxsize=QUERY_CACHE_SIZE)
+_search_cache = LRUCache(maxsize=QUERY_CACHE_SIZE)
+_cache_lock = threading.Lock()
+
+def _query_key(query: str) -> bytes:
+    return hashlib.blake2b(query.encode("utf-8"), digest_size=16).digest()
+
+def _embed_queries(queries: List[str]) -> np.ndarray:
+    """
+    Return a fresh (B, d) float32 array of raw query embeddings. Cached queries are
+    reused; all the others go to the embed endpoint together in a single request.
+    """
+    keys = [_query_key(q) for q in queries]
+    with _cache_lock:
+        vecs = [_embed_cache.get(k) for k in keys]
+    missing = [i for i, v in enumerate(vecs) if v is None]
+    if missing:
+        embs = call_llm_embed([queries[i] for i in missing])
+        if len(embs) != len(missing):
+            raise ValueError("Invalid embedding response")
+        new = embs
+        with _cache_lock:
+            for row, i in enumerate(missing):
+                vecs[i] = new[row]
+                _embed_cache[keys[i]] = new[row]
+    # np.vstack copies, and callers normalize in place, so cached arrays are never handed out
+    return np.vstack(vecs)
+
+def _embed_query(query: str) -> np.ndarray:
+    """Return a fresh (1, d) float32 copy of the query's raw embedding, from cache when possible."""
+    return _embed_queries([query])
+
+def _prepare_query_vecs(q_vec: np.ndarray):
+    """
+    Check (B, d) query embeddings against the index dim (re-initializing an empty index
+    for a new dim) and normalize them. Returns (q_vec, None) or (None, error message).
+    """
+    global EMBED_DIM
+    with _index_lock:
+        # dimension checks and potential re-init
+        if metadata.get("embed_dim", 0) == 0 and q_vec.shape[1] > 0:
+            # If no index vectors yet, set embed_dim to this model's dim
+            if _row_count == 0:
+                init_faiss(q_vec.shape[1], fresh=True)
+                EMBED_DIM = q_vec.shape[1]
+                metadata["embed_dim"] = EMBED_DIM
+                save_metadata()
+            else:
+                return None, "Unknown stored embed dim; please rebuild index or set EMBED_DIM"
+
+        if q_vec.shape[1] != metadata.get("embed_dim", EMBED_DIM):
+            # If index empty allow reinit
+            if _row_count == 0:
+                init_faiss(q_vec.shape[1], fresh=True)
+                metadata["embed_dim"] = q_vec.shape[1]
+                save_metadata()
+                EMBED_DIM = q_vec.shape[1]
+            else:
+                return None, f"Query embedding dim mismatch: returned {q_vec.shape[1]} != expected {metadata.get('embed_dim')}. If you changed embedding model rebuild index."
+
+    # normalize query vectors (in place)
+    q_vec = np.ascontiguousarray(q_vec, dtype=np.float32)
+    if not EMBED_NORMALIZED:
+        normalize_L2(q_vec)
+    return q_vec, None
+
+def _build_results(scores_row: np.ndarray, idx_row: np.ndarray, user_id=None, limit: Optional[int] = None) -> List[dict]:
+    """
+    Turn one row of FAISS (D, I) output into result dicts, looking the hits up in the
+    chunks table by row_id. Optionally keeps only chunks uploaded by user_id (filtered in
+    SQL) and at most `limit` hits, in score order.
+    """
+    valid = idx_row >= 0
+    idxs = idx_row[valid].tolist()
+    scores = scores_row[valid].tolist()
+    rows = {}
+    conn = _get_conn()
+    for i in range(0, len(idxs), _SQL_IN_MAX):
+        part = idxs[i:i + _SQL_IN_MAX]
+        sql = f"SELECT row_id, vid, {_CHUNK_COLS} FROM chunks WHERE row_id IN ({','.join('?' * len(part))})"
+        params = list(part)
+        if user_id is not None:
+            sql += " AND user_id = ?"
+            params.append(str(user_id))
+        for r in conn.execute(sql, params):
+            rows[r[0]] = r
+    results = []
+    for i, sc in zip(idxs, scores):
+        r = rows.get(i)
+        if r is None:
+            continue
+        results.append({"vector_id": r[1], "score": sc, "meta": dict(zip(CHUNK_FIELDS, r[2:]))})
+        if limit is not None and len(results) >= limit:
+            break
+    return results
+
+def _search_results(q_vec: np.ndarray, top_k: int, user_id=None) -> List[List[dict]]:
+    """
+    Search and assemble one result list per query row. With a user_id filter, FAISS is
+    asked for 4x top_k (growing further while filtered rows come up short).
+    Caller must hold _index_lock.
+    """
+    k = top_k if user_id is None else top_k * 4
+    while True:
+        D, I = _search_index(q_vec, k)
+        rows = [_build_results(D[b], I[b], user_id, top_k) for b in range(q_vec.shape[0])]
+        if user_id is None or k >= _indexed_count() or all(len(r) >= top_k for r in rows):
+            return rows
+        k *= 4
+
+class SearchBatcher:
+    """
+    Collects concurrent single-query searches into one FAISS call. search(q_row, top_k)
+    returns a Future of (results, index_version). A worker thread takes the first queued
+    query, gathers more for up to `window` seconds (at most max_batch), searches them as
+    one (B, d) matrix with the largest top_k and trims each row to its own top_k.
+    """
+
+    def __init__(self, window: float, max_batch: int):
+        self._queue = queue.Queue()
+        self._window = window
+        self._max_batch = max_batch
+        threading.Thread(target=self._run, name="search-batcher", daemon=True).start()
+
+    def search(self, q_row: np.ndarray, top_k: int) -> Future:
+        fut = Future()
+        self._queue.put((q_row, top_k, fut))
+        return fut
+
+    def _run(self):
+        while True:
+            group = [self._queue.get()]
+            deadline = time.monotonic() + self._window
+            while len(group) < self._max_batch:
+                try:
+                    group.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            try:
+                q = np.vstack([q_row for q_row, _, _ in group])
+                with _index_lock:
+                    D, I = _search_index(q, max(k for _, k, _ in group))
+                    version = _index_version
+                    # rows are resolved under the lock: a delete renumbers them
+                    out = [_build_results(D[b], I[b], None, k) for b, (_, k, _) in enumerate(group)]
+                for res, (_, _, fut) in zip(out, group):
+                    fut.set_result((res, version))
+            except Exception as e:
+                for _, _, fut in group:
+                    if not fut.done():
+                        fut.set_exception(e)
+
+_search_batcher: Optional[SearchBatcher] = None  # created by init_service()
+
 # ----------------- Routes -----------------
 @APP.route("/mcp/upload", methods=["POST"])
 def upload():
@@ -447,8 +1368,7 @@ def status(upload_id):
     row = get_status_row(upload_id)
     if not row:
         return jsonify({"error": "upload_id not found"}), 404
-    total_vectors = len(metadata.get("index_id_list", []))
-    row["total_vectors"] = total_vectors
+    row["total_vectors"] = _row_count
     return jsonify(row)
 
 @APP.route("/mcp/search", methods=["POST"])
@@ -458,6 +1378,8 @@ def search():
     query = (body.get("query") or "").strip()
     user_id = body.get("user_id")
     top_k = int(body.get("top_k", 5))
+    # "own_only": true limits results to chunks uploaded by user_id
+    filter_uid = user_id if body.get("own_only") and user_id is not None else None
 
     if not query:
         return jsonify({"error": "Empty query"}), 400
@@ -468,69 +1390,39 @@ def search():
         "results": []
     })
     
-    # 1) embed the query
-    try:
-        q_embs = call_llm_embed([query])
-    except Exception as e:
-        return jsonify({"error": f"Embed call failed: {e}"}), 500
+    # a repeated query against an unchanged index skips both the embed call and FAISS
+    qkey = _query_key(query)
+    with _cache_lock:
+        results = _search_cache.get((_index_version, qkey, top_k, filter_uid))
 
-    if not q_embs or not isinstance(q_embs, list):
-        return jsonify({"error": "Invalid embedding response"}), 500
-
-    q_vec = np.array(q_embs, dtype=np.float32)
-    if q_vec.ndim == 1:
-        q_vec = q_vec.reshape(1, -1)
-
-    # dimension checks and potential re-init
-    if metadata.get("embed_dim", 0) == 0 and q_vec.shape[1] > 0:
-        # If no index vectors yet, set embed_dim to this model's dim
-        if len(metadata.get("index_id_list", [])) == 0:
-            init_faiss(q_vec.shape[1])
-            EMBED_DIM = q_vec.shape[1]
-            metadata["embed_dim"] = EMBED_DIM
-            safe_write_json(META_PATH, metadata)
-        else:
-            return jsonify({"error": "Unknown stored embed dim; please rebuild index or set EMBED_DIM"}), 500
-
-    if q_vec.shape[1] != metadata.get("embed_dim", EMBED_DIM):
-        # If index empty allow reinit
-        if len(metadata.get("index_id_list", [])) == 0:
-            init_faiss(q_vec.shape[1])
-            metadata["embed_dim"] = q_vec.shape[1]
-            safe_write_json(META_PATH, metadata)
-            EMBED_DIM = q_vec.shape[1]
-        else:
-            return jsonify({"error": f"Query embedding dim mismatch: returned {q_vec.shape[1]} != expected {metadata.get('embed_dim')}. If you changed embedding model rebuild index."}), 500
+    if results is None:
+        # 1) embed the query
+        try:
+            q_vec = _embed_query(query)
+        except Exception as e:
+            return jsonify({"error": f"Embed call failed: {e}"}), 500
 
-    # normalize query vector
-    q_vec = normalize_vectors(q_vec)
+        q_vec, err = _prepare_query_vecs(q_vec)
+        if err:
+            return jsonify({"error": err}), 500
 
-    # no vectors yet
-    if _index is None or getattr(_index, "ntotal", 0) == 0:
-        return jsonify({"answer": "No indexed documents available yet.", "results": []})
+        # no vectors yet
+        if _index is None or _indexed_count() == 0:
+            return jsonify({"answer": "No indexed documents available yet.", "results": []})
 
-    try:
-        D, I = _index.search(q_vec, top_k)
-    except Exception as e:
-        return jsonify({"error": f"FAISS search failed: {e}"}), 500
-
-    scores = D[0].tolist()
-    idxs = I[0].tolist()
-
-    results = []
-    for score, idx in zip(scores, idxs):
-        if idx < 0:
-            continue
         try:
-            vid = metadata["index_id_list"][idx]
-            meta = metadata["vectors"].get(vid, {})
-            results.append({
-                "vector_id": vid,
-                "score": float(score),
-                "meta": meta
-            })
-        except Exception:
-            continue
+            if filter_uid is None:
+                # unfiltered single queries share FAISS calls with concurrent requests
+                results, version = _search_batcher.search(q_vec[0], top_k).result()
+            else:
+                with _index_lock:
+                    results = _search_results(q_vec, top_k, filter_uid)[0]
+                    version = _index_version
+            skey = (version, qkey, top_k, filter_uid)
+        except Exception as e:
+            return jsonify({"error": f"FAISS search failed: {e}"}), 500
+        with _cache_lock:
+            _search_cache[skey] = results
 
     # Build RAG prompt (intentionally kept permissive for your project)
     context_texts = []
@@ -546,7 +1438,7 @@ def search():
 
     answer_text = ""
     try:
-        r = requests.post(LLM_TEXT_ENDPOINT, json={"prompt": rag_prompt, "mode": "text"}, timeout=30)
+        r = _http.post(LLM_TEXT_ENDPOINT, json={"prompt": rag_prompt, "mode": "text"}, timeout=30)
         r.raise_for_status()
         answer_text = (r.json().get("text") or "").strip()
     except Exception as e:
@@ -557,33 +1449,76 @@ def search():
     return jsonify({"answer": answer_text, "results": results})
 
 
+@APP.route("/mcp/search_batch", methods=["POST"])
+def search_batch():
+    """
+    Request JSON: { "queries": ["...", "..."], "top_k": 5, "user_id": "...", "own_only": false }
+    Returns { "results": [[...], [...]] } (one result list per query, no RAG answer).
+    All queries go to FAISS as one (B, d) matrix, which it searches in parallel.
+    """
+    body = request.get_json(force=True) or {}
+    queries = body.get("queries")
+    top_k = int(body.get("top_k", 5))
+    user_id = body.get("user_id")
+    filter_uid = user_id if body.get("own_only") and user_id is not None else None
+
+    if not isinstance(queries, list) or not queries or not all(isinstance(q, str) and q.strip() for q in queries):
+        return jsonify({"error": "'queries' must be a non-empty list of non-empty strings"}), 400
+
+    try:
+        # one embed request for every query not already cached
+        q_vec = _embed_queries([q.strip() for q in queries])
+    except Exception as e:
+        return jsonify({"error": f"Embed call failed: {e}"}), 500
+
+    q_vec, err = _prepare_query_vecs(q_vec)
+    if err:
+        return jsonify({"error": err}), 500
+
+    if _index is None or _indexed_count() == 0:
+        return jsonify({"results": [[] for _ in queries]})
+
+    try:
+        with _index_lock:
+            results = _search_results(q_vec, top_k, filter_uid)
+    except Exception as e:
+        return jsonify({"error": f"FAISS search failed: {e}"}), 500
+
+    return jsonify({"results": results})
+
+
 # Book-level endpoints
+# books in registration order, each with its chunk count (an index lookup per book)
+_BOOKS_WITH_COUNTS_SQL = (
+    f"SELECT book_id, {', '.join('b.' + f for f in BOOK_FIELDS)}, "
+    "(SELECT COUNT(*) FROM chunks c WHERE c.book_id = b.book_id) FROM books b ORDER BY b.rowid"
+)
+
 @APP.route("/mcp/list_books", methods=["GET"])
 def list_books():
     books = []
-    for bid, b in metadata.get("books", {}).items():
+    for row in _get_conn().execute(_BOOKS_WITH_COUNTS_SQL):
+        b = dict(zip(("book_id",) + BOOK_FIELDS + ("vector_count",), row))
         books.append({
-            "book_id": bid,
-            "title": b.get("title"),
-            "author": b.get("author"),
-            "genre": b.get("genre"),
-            "filename": b.get("filename"),
-            "upload_id": b.get("upload_id"),
-            "vector_count": len(b.get("vector_ids", [])),
-            "created_at": b.get("created_at")
+            "book_id": b["book_id"],
+            "title": b["title"],
+            "author": b["author"],
+            "genre": b["genre"],
+            "filename": b["filename"],
+            "upload_id": b["upload_id"],
+            "vector_count": b["vector_count"],
+            "created_at": b["created_at"]
         })
     return jsonify({"books": books})
 
 @APP.route("/mcp/get_book/<book_id>", methods=["GET"])
 def get_book(book_id):
-    b = metadata.get("books", {}).get(book_id)
+    b = _get_book(book_id)
     if not b:
         return jsonify({"error": "book_id not found"}), 404
-    sample_vecs = []
-    for vid in b.get("vector_ids", [])[:6]:
-        vmeta = metadata["vectors"].get(vid, {})
-        sample_vecs.append({"vector_id": vid, "text": vmeta.get("text", "")})
-    out = {**b, "samples": sample_vecs}
+    rows = _get_conn().execute("SELECT vid, text FROM chunks WHERE book_id = ? ORDER BY row_id", (book_id,)).fetchall()
+    sample_vecs = [{"vector_id": vid, "text": text or ""} for vid, text in rows[:6]]
+    out = {**b, "vector_ids": [vid for vid, _ in rows], "samples": sample_vecs}
     return jsonify(out)
 
 @APP.route("/mcp/delete_book", methods=["POST"])
@@ -592,7 +1527,7 @@ def delete_book():
     Request JSON: { "book_id": "..." } or { "upload_id": "..." }
     Deletes all vectors and metadata for the book and rebuilds the FAISS index.
     """
-    global _index  # Declare _index as global since we're modifying it
+    global _index, _row_count  # Declare as global since we're modifying them
     
     body = request.get_json(force=True) or {}
     book_id = body.get("book_id")
@@ -602,87 +1537,135 @@ def delete_book():
     if not book_id and not upload_id:
         return jsonify({"error": "book_id or upload_id required"}), 400
     
-    # If upload_id provided, try to find the book_id
-    if not book_id and upload_id:
-        # Search for book by upload_id
-        for bid, bdata in metadata.get("books", {}).items():
-            if bdata.get("upload_id") == upload_id:
-                book_id = bid
-                break
-    
-    # Check if book exists
-    if book_id not in metadata.get("books", {}):
-        # If still not found, try using upload_id as book_id (fallback)
-        if upload_id and upload_id in metadata.get("books", {}):
-            book_id = upload_id
-        else:
-            return jsonify({"error": f"Book not found with book_id={book_id} or upload_id={upload_id}"}), 404
-
-    remove_vids = set(metadata["books"][book_id].get("vector_ids", []))
-    # remove vectors and index mapping
-    for vid in remove_vids:
-        metadata["vectors"].pop(vid, None)
-    metadata["index_id_list"] = [vid for vid in metadata.get("index_id_list", []) if vid not in remove_vids]
-    # remove book record
-    metadata["books"].pop(book_id, None)
-    safe_write_json(META_PATH, metadata)
-
-    # rebuild index from remaining vectors
-    try:
-        remaining_vids = metadata.get("index_id_list", [])
-        if not remaining_vids:
-            # reset empty index
-            if metadata.get("embed_dim", 0):
-                init_faiss(metadata.get("embed_dim"))
+    with _index_lock:
+        # If upload_id provided, try to find the book_id
+        if not book_id and upload_id:
+            # Search for book by upload_id
+            row = _get_conn().execute("SELECT book_id FROM books WHERE upload_id = ? ORDER BY rowid LIMIT 1", (upload_id,)).fetchone()
+            if row:
+                book_id = row[0]
+
+        # Check if book exists
+        if not book_id or _get_book(book_id) is None:
+            # If still not found, try using upload_id as book_id (fallback)
+            if upload_id and _get_book(upload_id) is not None:
+                book_id = upload_id
             else:
-                _index = None
-            # FIXED: Add index_path parameter to write_index
-            if _index is not None:
-                faiss.write_index(_index, index_path)
-            return jsonify({"status": "deleted", "remaining_vectors": 0})
-
-        emb_list = []
-        for vid in remaining_vids:
-            v = metadata["vectors"].get(vid, {})
-            emb = v.get("embedding")
-            if emb is None:
-                return jsonify({"error": f"Missing stored embedding for vector {vid}, cannot rebuild index"}), 500
-            emb_list.append(emb)
-
-        emb_np = np.array(emb_list, dtype=np.float32)
-        emb_np = normalize_vectors(emb_np)
-        init_faiss(emb_np.shape[1])
-        _index.add(emb_np)
-        # FIXED: Proper faiss.write_index call with both parameters
-        faiss.write_index(_index, index_path)
-        return jsonify({"status": "deleted", "remaining_vectors": len(remaining_vids)})
-    except Exception as e:
-        print("[mcp] Rebuild error:", e)
-        return jsonify({"error": f"Failed to rebuild index after deletion: {e}"}), 500
+                return jsonify({"error": f"Book not found with book_id={book_id} or upload_id={upload_id}"}), 404
+
+        # remove the book record and its chunk rows and vectors (renumbering the rest)
+        kept = _delete_chunks_for_book(book_id)
+        _row_count = _count_chunks()
+
+        # rebuild index from remaining vectors
+        try:
+            remaining = _rebuild_index_from_db(kept if kept.shape[0] == _row_count else None)
+        except Exception as e:
+            print("[mcp] Rebuild error, retrying from a fresh index:", e)
+            # the rows are renumbered already, so the old index's ids point at other chunks
+            # and must never be served again
+            init_faiss(EMBED_DIM, fresh=True)
+            try:
+                remaining = _rebuild_index_from_db()
+            except Exception as e_retry:
+                # leave it empty; the count mismatch triggers a rebuild at next startup, and
+                # the version bump drops cached search results
+                print("[mcp] Rebuild retry failed, index left empty:", e_retry)
+                init_faiss(EMBED_DIM, fresh=True)
+                _mark_index_dirty()
+                return jsonify({"error": f"Failed to rebuild index after deletion: {e_retry}"}), 500
+        _flush_index_and_meta()
+        return jsonify({"status": "deleted", "remaining_vectors": remaining})
 
 # Health
 @APP.route("/mcp/health", methods=["GET"])
 def health():
-    return jsonify({"status": "ok", "indexed_vectors": len(metadata.get("index_id_list", [])), "embed_dim": metadata.get("embed_dim", 0)})
+    return jsonify({"status": "ok", "indexed_vectors": _row_count, "embed_dim": metadata.get("embed_dim", 0)})
 
 # Debug endpoint to see all book IDs
 @APP.route("/mcp/debug/books", methods=["GET"])
 def debug_books():
     """Debug endpoint to see all book IDs and their metadata"""
     books_info = {}
-    for bid, bdata in metadata.get("books", {}).items():
-        books_info[bid] = {
-            "book_id": bid,
-            "upload_id": bdata.get("upload_id"),
-            "title": bdata.get("title"),
-            "author": bdata.get("author"),
-            "vector_count": len(bdata.get("vector_ids", []))
+    for row in _get_conn().execute(_BOOKS_WITH_COUNTS_SQL):
+        bdata = dict(zip(("book_id",) + BOOK_FIELDS + ("vector_count",), row))
+        books_info[bdata["book_id"]] = {
+            "book_id": bdata["book_id"],
+            "upload_id": bdata["upload_id"],
+            "title": bdata["title"],
+            "author": bdata["author"],
+            "vector_count": bdata["vector_count"]
         }
     return jsonify({
         "total_books": len(books_info),
         "books": books_info
     })
 
+# ----------------- Startup -----------------
+_started = False
+_start_lock = threading.Lock()
+
+def init_service():
+    """
+    Bring the service up: status DB schema, legacy migrations, FAISS index load (rebuilt when
+    it lags the chunks table), the index writer and the embed/search batchers. Called by the
+    entry points below, never at import: PDF workers re-import the main module, and must not
+    repeat any of this. Runs once per process.
+    """
+    global _started, _row_count, EMBED_DIM, _embed_batcher, _search_batcher
+    with _start_lock:
+        if _started:
+            return
+        init_status_db()
+        if "vectors" in metadata or "index_id_list" in metadata or os.path.exists(META_JOURNAL_PATH):
+            _migrate_legacy_metadata()
+        _migrate_chunk_blobs()
+        if "books" in metadata:
+            _migrate_books_from_metadata()
+        _recover_compacted_vectors()
+        _row_count = _count_chunks()
+
+        # If EMBED_DIM was recorded in metadata use that; else if env provided use env; else leave 0 until first embed
+        if metadata.get("embed_dim", 0):
+            EMBED_DIM = int(metadata["embed_dim"])
+        if EMBED_DIM and EMBED_DIM > 0:
+            init_faiss(EMBED_DIM)
+        else:
+            # create a tiny placeholder index until we know the dimension (will be reinitialized later)
+            print("[mcp] EMBED_DIM unknown at startup; FAISS will be initialized upon first embeddings.")
+        faiss.omp_set_num_threads(FAISS_THREADS)
+
+        # The index file is written lazily, so after a crash it can lag behind the chunks
+        # table; rebuild it from the stored embeddings when the counts disagree.
+        if _index is not None and _indexed_count() != _row_count:
+            print(f"[mcp] FAISS index has {_indexed_count()} vectors, chunks table has {_row_count}; rebuilding.")
+            try:
+                _rebuild_index_from_db()
+                _mark_index_dirty()
+            except Exception as e:
+                print("[mcp] Index rebuild at startup failed:", e)
+
+        threading.Thread(target=_index_writer, name="faiss-writer", daemon=True).start()
+        atexit.register(_write_index_at_exit)
+
+        # Merged embed POSTs stay within one upload batch (the llm service's batch size too), so
+        # a full batch is never merged with others and an upload's batches still run
+        # max_inflight at a time.
+        _embed_batcher = EmbedBatcher(
+            max_texts=EMBED_BATCH if EMBED_BATCH > 0 else 32,
+            window=EMBED_COALESCE_MS / 1000.0,
+            max_inflight=max(1, EMBED_CONCURRENCY),
+        )
+        _search_batcher = SearchBatcher(window=SEARCH_BATCH_MS / 1000.0, max_batch=max(1, SEARCH_BATCH_MAX))
+        _started = True
+
+def create_app():
+    """gunicorn entry point ("app:create_app()", see Dockerfile)."""
+    init_service()
+    return APP
+
 if __name__ == "__main__":
     print("[mcp] Starting MCP service on port 8001")
-    APP.run(host="0.0.0.0", port=8001, debug=True)
\ No newline at end of file
+    init_service()
+    # development entry point; the container runs gunicorn (see Dockerfile)
+    APP.run(host="0.0.0.0", port=8001, debug=os.getenv("MCP_DEBUG", "1") == "1")
\ No newline at end of file
@@ -1,17 +1,37 @@
 import os
 import uuid
 import json 
-import math 
+import numpy as np
 from pdfminer.high_level import extract_text
-from tqdm import tqdm
+
+try:
+    import orjson
+except ImportError:  # fall back to the stdlib encoder
+    orjson = None
+
+try:
+    import pypdfium2 as pdfium
+except ImportError:  # fall back to pdfminer's pure-Python extractor
+    pdfium = None
 
 def ensure_dir(p):
     os.makedirs(p, exist_ok=True)
 
 def extract_text_from_pdf(path: str) -> str:
     '''
-    Use pdfminer to extract text from a PDF file.
+    Extract text from a PDF file with PDFium (native, no layout analysis) when pypdfium2
+    is installed; pdfminer is used otherwise or when PDFium can't open the file.
     '''
+    if pdfium is not None:
+        try:
+            pdf = pdfium.PdfDocument(path)
+            try:
+                text = "\n".join(page.get_textpage().get_text_range() for page in pdf)
+            finally:
+                pdf.close()
+            return text.replace("\r\n", "\n")
+        except Exception:
+            pass
     return extract_text(path) or ""
 
 def chunk_text(text: str, chunk_size_chars: int = 1500, overlap_chars: int = 200, book_id: str = None):
@@ -21,38 +41,57 @@ def chunk_text(text: str, chunk_size_chars: int = 1500, overlap_chars: int = 200
     '''
     if not text:
         return []
-    
-    chunks = []
-    i = 0
+
     n = len(text)
-    
-    while i < n:
-        end = min(i + chunk_size_chars, n)
-        chunk_txt = text[i:end].strip()
-        
+    # windows start every chunk_size - overlap chars (whole chunks if overlap >= chunk size)
+    step = chunk_size_chars - overlap_chars if chunk_size_chars > overlap_chars else chunk_size_chars
+    starts = np.arange(0, n, step, dtype=np.int64)
+    ends = np.minimum(starts + chunk_size_chars, n)
+    # one urandom call for all ids instead of one per uuid4()
+    rand = os.urandom(16 * len(starts))
+
+    chunks = []
+    for k, (start, end) in enumerate(zip(starts.tolist(), ends.tolist())):
+        chunk_txt = text[start:end].strip()
         if chunk_txt:
             chunks.append({
-                "id": str(uuid.uuid4()),
+                "id": str(uuid.UUID(bytes=rand[16 * k:16 * k + 16], version=4)),
                 "text": chunk_txt,
-                "start": i,
+                "start": start,
                 "end": end,
                 "book_id": book_id
             })
-        # move by chunk_size - overlap (ensure progress)
-        next_i = end - overlap_chars
-        i = next_i if next_i > i else end
-    
+        if end == n:
+            break
+
     return chunks
 
+def extract_and_chunk(path: str, chunk_size_chars: int = 1500, overlap_chars: int = 200, book_id: str = None):
+    '''
+    Extract a PDF's text and chunk it in one call, so both CPU-bound steps can run in a
+    worker process. Returns None when no text could be extracted, else chunk_text's list.
+    '''
+    text = extract_text_from_pdf(path)
+    if not text or not text.strip():
+        return None
+    return chunk_text(text, chunk_size_chars=chunk_size_chars, overlap_chars=overlap_chars, book_id=book_id)
+
+def json_loads(data):
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
 def safe_write_json(path, obj):
+    if orjson is not None:
+        with open(path, "wb") as f:
+            f.write(orjson.dumps(obj, option=orjson.OPT_APPEND_NEWLINE))
+        return
     with open(path, "w", encoding="utf-8") as f:
         json.dump(obj, f, ensure_ascii=False, indent=2)
 
 def safe_read_json(path, default):
     if not os.path.exists(path):
         return default
-    with open(path, "r", encoding="utf-8") as f:
+    with open(path, "rb") as f:
         try:
-            return json.load(f)
+            return json_loads(f.read())
         except Exception:
             return default
\ No newline at end of file